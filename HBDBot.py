@@ -7,24 +7,80 @@
 # - 一時間ごとに変数の中身をJSONテキストに保存する
 
 from misskey import Misskey, NoteVisibility, exceptions, MiAuth
-from datetime import date, datetime, timedelta, timezone
+from datetime import date, datetime, timedelta
+import os
+import re
+import sys
+import hashlib
+import logging
+import signal
 import time
 import random
-from requests import ReadTimeout
+from collections import Counter
+from functools import lru_cache
+from requests import ReadTimeout, RequestException
 
-from ratelimit import rate_limit
 from JSONSave import JSONSave
+from ratelimit import get_bucket, use_clock, buckets as ratelimit_buckets
+from statestore import SQLiteStateStore, migrate_json
+from usercache import UserCache
+from birthdays import BirthdayStore, parse_birthday, datediff
+from clock import Clock
+from outbox import Outbox
+from seenids import SeenIds
+from scheduler import PollScheduler, spread
+from followersync import FollowerSync
+from hostpool import HostRegistry, HostUnavailable
+from workers import KeyedPool
+import metrics
+from metrics import api_calls, api_seconds, stage_seconds, timed
+from profiler import Profiler
+import botlog
+from botlog import lazy
 
 _silent_mode = False
 # サイレントモード：投稿やリアクションを一切行わず、
 # 通知とTLのチェックのみ行ってリストを更新してすぐ終了します。
 # 強制終了などで保存できなかったデータを回収する時に使います。
 
-JST = timezone(timedelta(hours=9), "JST")
-FILE_NAME = "variables.json"
+FILE_NAME = "variables.json" #以前の保存ファイル。初回起動時に移行する
+STATE_FILE_NAME = "state.sqlite3"
+OUTBOX_FILE_NAME = "outbox.jsonl"
+LOG_FILE_NAME = "hbdbot.log.jsonl" #一件一行のJSON。大きくなったら.1, .2...に回す
+PROFILE_FILE_PREFIX = "profile" #プロファイルの書き出し先（profile-日時.folded/.prof）
+CONFIG_FILE_NAME = "config.json" #手で書き換える設定値。動いている間も読み直す
+SNAPSHOT_FILE_NAME = "birthdays.snapshot" #誕生日の表をそのまま書き出したもの。起動を速くする
 VERSION = "ver 0.5 beta test"
 ADMIN = ""
 
+users_show_bucket = get_bucket('users/show', limit_pm=60)
+notes_create_bucket = get_bucket('notes/create', limit_ph=60, limit_pm=5,
+                                 post_rate=1)
+reactions_bucket = get_bucket('notes/reactions/create', limit_ph=300,
+                              limit_pm=10, post_rate=1)
+hosts = HostRegistry() #サーバーごとのクライアント。HBDBot.load()でhomeを設定する
+user_cache = UserCache(maxsize=2000, ttl=3600)
+# ユーザー情報のキャッシュ。同じユーザーのノートが何度流れてきても
+# users_showは有効期限（秒）ごとに一回だけ呼ぶ。
+log = logging.getLogger('hbdbot')
+clock = Clock()
+# 日付と時刻はすべてここから取る。今日の日付はhousekeeping()でのtick()ごとに更新。
+# テストではHBDBotを作る前にSimulatedClockに差し替えると日付を早送りできる。
+
+def data_path(file_name, data_dir=None) -> str:
+    '''このスクリプトと同じフォルダ（data_dirを指定したらそこ）にあるファイルのパスを返します。'''
+    if data_dir is not None:
+        return os.path.join(data_dir, file_name)
+    return __file__[:__file__.rfind('\\')+1] + file_name
+
+@lru_cache(maxsize=8)
+def keyword_pattern(keywords: tuple, ignore_case=False):
+    '''keywordsのどれかを含むかを一度で調べる正規表現を返します。
+    設定を読み直して変わったときだけ作り直します。'''
+    return re.compile('|'.join(re.escape(k) for k in
+                               sorted(keywords, key=len, reverse=True)),
+                      re.IGNORECASE if ignore_case else 0)
+
 def has_past(dt, **kwargs) -> bool:
     """時刻dtから指定の時間が経ったかどうかを返します。
 
@@ -37,11 +93,22 @@ def has_past(dt, **kwargs) -> bool:
     """
     if type(dt) is str:
         dt = datetime.fromisoformat(dt)
-    return dt+timedelta(**kwargs) < datetime.now()
+    return dt+timedelta(**kwargs) < clock.now()
 
 #Misskey.pyの関数補完
 class Misskey_Antenna(Misskey):
 
+    def _Misskey__request_api(self, endpoint_name, **payload):
+        '''APIの呼び出し回数と所要時間を記録する'''
+        result = 'error'
+        try:
+            with api_seconds.time(endpoint=endpoint_name):
+                response = super()._Misskey__request_api(endpoint_name, **payload)
+            result = 'ok'
+            return response
+        finally:
+            api_calls.inc(endpoint=endpoint_name, result=result)
+
     def notes_antennas(
         self,
         antenna_id: str,
@@ -53,7 +120,7 @@ class Misskey_Antenna(Misskey):
         ):
         '''antenna_idで指定したアンテナのノートを返します。'''
         params = Misskey._Misskey__params(locals())
-        print(params)
+        log.debug('antennas/notes %s', params)
         return self._Misskey__request_api(endpoint_name='antennas/notes', **params)
     
     def notes_timeline(
@@ -67,43 +134,22 @@ class Misskey_Antenna(Misskey):
         params = Misskey._Misskey__params(locals())
         return self._Misskey__request_api(endpoint_name='notes/timeline', **params)
         
+    # 投稿とリアクションはOutbox経由で送るので、ここでは再送や待機をしない。
+    # 失敗したときの例外はそのままOutboxに返す。
     def notes_reactions_create(self, *args, **kwargs):
         try:
             if not _silent_mode:
                 super().notes_reactions_create(*args,**kwargs)
         except exceptions.MisskeyAPIException:
             pass #既にリアクションがついている
-        except ReadTimeout:
-            print('❗❗❗リアクションタイムアウト❗❗❗')
-            pass
 
-    @rate_limit(limit_pm=5)
+    @timed('notes_create')
     def notes_create(self, *args, **kwargs):
-        posted = False
-        count = 0
-        while not posted:
-            if count >= 10:
-                print('❗❗❗投稿に立て続けに失敗❗❗❗')
-                break
-            try:
-                if not _silent_mode:
-                    super().notes_create(*args, **kwargs)
-                posted = True
-            except ReadTimeout:
-                print('❗❗❗投稿タイムアウト❗❗❗')
-                time.sleep(60)
-                count += 1
-                continue
-            except exceptions.MisskeyAPIException as e:
-                if e.code == 'TIMELINE_HAYASUGI_YABAI':
-                    print('タイムライン速すぎヤバイエラー❗')
-                print(e)
-                time.sleep(60)
-                count += 1
-                continue
+        if not _silent_mode:
+            super().notes_create(*args, **kwargs)
 
     def dm_admin(self, message):
-        print('❗📧', message[:100])
+        log.warning('❗📧 %s', message[:100])
         super().notes_create(
             text="@"+self.admin+' '+message,
             visibility=NoteVisibility.SPECIFIED,
@@ -118,110 +164,186 @@ class TimelineHandler:
                  max_period = timedelta(days=1),
                  refresh_rate = 1.0, #sec
                  batch_size = 10,
-                 desc = True,
+                 max_pages = 10,
+                 time_budget = 10.0, #sec
+                 on_commit = None,
                  **param
                  ):
         self.timeline = timeline
         self.max_period: timedelta = max_period
         self.refresh_rate: float = refresh_rate
         self.batch_size: int = batch_size
-        self.desc: bool = desc
+        self.max_pages: int = max_pages #一度に追いかけるページ数の上限
+        self.time_budget: float = time_budget #一度に追いかける時間の上限
         self.since_id = None
+        self.on_commit = on_commit #処理し終えた位置を知らせる関数（保存する）
+        self.backlog = 0 #前回の読み込みで最初のページに収まらなかった件数
+        self.caught_up = True #前回の読み込みで最新まで追いついたかどうか
+        self.calls = 0 #前回の読み込みでAPIを呼んだ回数（ページ数）
         self.param = param
-    
-    def get_timeline(self):
-        '''Retrun recent updates.'''
-        try:
-            result = self.timeline(limit=self.batch_size,
-                                sinceId=self.since_id,
-                                **self.param)
-        except ReadTimeout:
-            print('❗❗❗TL読み込みタイムアウト❗❗❗')
-            return []
-        time.sleep(self.refresh_rate)
-        if not result:
-            return []
-        if self.desc:
-            self.since_id = result[0]['id']
-        else:
-            self.since_id = result[-1]['id']
+
+    def get_timeline(self, wait=True):
+        '''Retrun recent updates, oldest first.
+        前回の続きから、最新に追いつくまでページをめくって読み込みます。
+        ただしmax_pagesかtime_budgetを超えたら残りは次回に回します。
+        wait=Falseなら読み込み後のrefresh_rate秒の待機をしません。'''
+        result = []
+        started = time.monotonic()
+        self.caught_up = False
+        for pages in range(1, self.max_pages+1):
+            self.calls = pages
+            try:
+                page = self.timeline(limit=self.batch_size,
+                                     sinceId=self.since_id,
+                                     **self.param)
+            except ReadTimeout:
+                log.warning('❗❗❗TL読み込みタイムアウト❗❗❗')
+                break
+            if not page:
+                self.caught_up = True
+                break
+            #IDは時刻順に並ぶので、並び順によらず最大のIDまで読んだことにする
+            page.sort(key=lambda n: n['id'])
+            result += page
+            first_read = self.since_id is None
+            self.advance(page[-1])
+            if first_read or len(page) < self.batch_size:
+                self.caught_up = True
+                break
+            if time.monotonic() - started > self.time_budget:
+                break
+        self.backlog = max(0, len(result) - self.batch_size)
+        if not self.caught_up:
+            log.warning('❗TLの読み込みが追いついていません（%d件読み込み済み）', len(result))
+        if wait:
+            clock.sleep(self.refresh_rate)
         return result
 
+    def advance(self, note):
+        '''noteまで読んだことにします。
+        noteがmax_periodより古い場合は追いかけるのをやめて、次回は最新から読みます。'''
+        created = datetime.fromisoformat(note['createdAt']).timestamp()
+        if created + self.max_period.total_seconds() < clock.time():
+            self.since_id = None
+        else:
+            self.since_id = note['id']
+
+    def commit(self, since_id):
+        '''since_idまでのノートを処理し終えたことを知らせます。
+        読み込んだだけの位置は保存しないので、処理する前に落ちても読み直せます。'''
+        if self.on_commit is not None:
+            self.on_commit(since_id)
+
 class NotificationHandler:
     '''通知の取得をコントロールする'''
 
     def __init__(self,
                  mk,
                  refresh_rate = 1.0, #sec
-                 batch_size = 10
+                 batch_size = 10,
+                 on_commit = None
                  ):
         self.mk = mk
         self.refresh_rate: float = refresh_rate
         self.batch_size: int = batch_size
         self.since_id = None
-    
-    def get_notification(self):
+        self.on_commit = on_commit #処理し終えた位置を知らせる関数（保存する）
+        self.include_types = ('mention', 'reply', 'follow', 'renote', 'quote')
+        self.calls = 1 #一回の読み込みでAPIを呼ぶ回数
+
+    def get_notification(self, wait=True):
+        '''新着の通知を返します。
+        wait=Falseなら読み込み後のrefresh_rate秒の待機をしません。'''
         try:
             result = self.mk.i_notifications(
                 limit=self.batch_size,
                 since_id=self.since_id,
-                include_types=('mention', 'reply', 'follow', 'renote', 'quote'))
+                include_types=self.include_types)
         except ReadTimeout:
-            print('❗❗❗通知読み込みタイムアウト❗❗❗')
+            log.warning('❗❗❗通知読み込みタイムアウト❗❗❗')
             return []
-        time.sleep(self.refresh_rate)
+        if wait:
+            clock.sleep(self.refresh_rate)
         result = [n for n in result if n['id'] != self.since_id]
         if not result:
             return []
         self.since_id = result[0]['id']
         return result
 
-def is_leap_year(year:int) -> bool:
-    '''西暦年を入力すると閏年かどうか返します。'''
-    if year%400 == 0:
-        return True
-    if year%100 == 0:
-        return False
-    if year%4 == 0:
-        return True
-    return False
+    def commit(self, since_id):
+        '''since_idまでの通知を処理し終えたことを知らせます。'''
+        if self.on_commit is not None:
+            self.on_commit(since_id)
 
 class MisskeyUser:
-    """ミスキーユーザ"""
+    """ミスキーユーザ
+    サーバーが応答しない場合はHostUnavailableを投げます。"""
+    @timed('MisskeyUser.__init__')
     def __init__(self, username, host=None):
         if '@' in username:
             self.username, self.host = username.split("@")
         else:
             self.username = username
             self.host = host
-        user_read = False
-        while not user_read:
-            try:
-                if self.host is None:
-                    u = Misskey().users_show(username=self.username)
-                else:
-                    u = Misskey(self.host).users_show(username=self.username)
-            except ReadTimeout:
-                print('❗❗❗ユーザー情報タイムアウト❗❗❗')
-                time.sleep(1)
-                continue
-            user_read = True
+        users_show_bucket.wait()
+        try:
+            with api_seconds.time(endpoint='users/show'):
+                u = hosts.users_show(self.username, self.host)
+        except (HostUnavailable, RequestException):
+            api_calls.inc(endpoint='users/show', result='error')
+            log.warning('❗❗❗ユーザー情報タイムアウト❗❗❗ %s', self.host)
+            raise
+        api_calls.inc(endpoint='users/show', result='ok')
         self.useralias = u['name']
         self.bd = u['birthday']
 
     @staticmethod
     def from_dict(dict):
-        username = dict['username']
+        if not MisskeyUser.is_supported(dict):
+            return
+        return MisskeyUser.lookup(dict['username'], dict['host'])
+
+    @staticmethod
+    def is_supported(dict) -> bool:
+        '''ユーザーのサーバーがMisskeyかどうかを返します。通信はしません。'''
         host = dict['host']
-        if host is not None:
-            sn = dict['instance']['softwareName']
-            if sn != 'misskey':
-                return
-        result = None
-        result = MisskeyUser(username, host)
+        if host is None:
+            return True
+        if hosts.is_unsupported(host):
+            return False
+        sn = dict.get('instance', {}).get('softwareName')
+        if sn is None:
+            return False
+        if sn != 'misskey':
+            hosts.mark_unsupported(host)
+            return False
+        return True
+
+    @staticmethod
+    def lookup(username, host=None):
+        '''キャッシュにあればそれを、無ければ取得してキャッシュしたものを返します。'''
+        key = MisskeyUser.make_key(username, host)
+        result = user_cache.get(key)
+        if result is None:
+            with stage_seconds.time(stage='resolve'):
+                result = MisskeyUser(username, host)
+            user_cache.put(key, result)
         return result
 
-    
+    @staticmethod
+    def make_key(username, host=None) -> str:
+        '''username@host 形式のキーを返します。'''
+        if '@' in username:
+            return username
+        if host is not None:
+            return username+'@'+host
+        return username
+
+    @staticmethod
+    def key_from_dict(dict) -> str:
+        '''APIが返したユーザー情報からキーを作ります。通信はしません。'''
+        return MisskeyUser.make_key(dict['username'], dict['host'])
+
     @property
     def name_w_host(self):
         '''ホストが設定されているならホスト付きのユーザネームを返します。'''
@@ -232,36 +354,19 @@ class MisskeyUser:
 
     def get_bd(self) -> date|None:
         '''date型で誕生日を返す'''
-        if self.bd:
-            return date.fromisoformat(self.bd)
-        return None
+        return parse_birthday(self.bd)
     
-    def datediff(self) -> int:
-        '''今日と誕生日の日付の差を返します。明日なら－１、当日なら０、昨日なら１です。
+    def datediff(self, day=None) -> int:
+        '''今日（dayを指定したらその日）と誕生日の日付の差を返します。
+        明日なら－１、当日なら０、昨日なら１です。
         2月29日生で今年が平年の場合、3月1日を誕生日として扱います。
         誕生日が設定されていない場合はNoneを返します。'''
-        if (birthday := self.get_bd()) is None:
-            return None
-        dt = date.today()
-        bmonth = birthday.month
-        bday = birthday.day
-        if bmonth == 2 and bday == 29 and not is_leap_year(dt.year):
-            bmonth, bday = 3, 1
-        result = (dt-date(dt.year, bmonth, bday)).days
-        #今が年末で、誕生日が年始の場合
-        if result-is_leap_year(dt.year) >= 363:
-            result = result-is_leap_year(dt.year) - 365
-        #今が年始で、誕生日が年末の場合
-        if result+is_leap_year(dt.year) <= -363:
-            result = result+is_leap_year(dt.year) + 365
-        return result
+        return datediff(self.bd, day or clock.today)
     
-    def is_birthday(self) -> bool:
-        '''今日が誕生日かどうかを返します。
+    def is_birthday(self, day=None) -> bool:
+        '''今日（dayを指定したらその日）が誕生日かどうかを返します。
         未設定の場合はFalseです。'''
-        if self.bd == "":
-            return False
-        return self.datediff() == 0
+        return self.datediff(day) == 0
     
     @property
     def bd_str(self):
@@ -275,8 +380,10 @@ class HBDConversations:
 
     def __init__(
             self, 
-            user: MisskeyUser):
+            user: MisskeyUser,
+            day: date = None): #返信する日。0時前に翌日のお祝いを作るときに指定する
         self.user = user
+        self.day = day
 
     def greet(self):
         '''呼びかけ部分の定型文'''
@@ -297,7 +404,7 @@ class HBDConversations:
                 '望みが叶う一年になりますように！']
         
         result = ":happy_birth_day__i:\n"
-        if self.user.is_birthday():
+        if self.user.is_birthday(self.day):
             result += random.choice(s1)+'\n'+random.choice(s2)
         else:
             result += random.choice(s1)+'\n'+random.choice(s3)
@@ -306,25 +413,26 @@ class HBDConversations:
     def bdmessage(self):
         '''誕生日を反映したメッセージ'''
         result = ""
-        if self.user.get_bd() is None:
+        diff = self.user.datediff(self.day)
+        if diff is None:
             result += "まだプロフィールに誕生日を設定してないみたいだね。\n"
             result += "設定が済んだら「登録して」って話しかけてね！\n"
             result += "（個人情報だから少しサバ読んで設定するのもいいかも）\n"
             result += "お誕生日をお祝いできるのを楽しみにしてるよ！\n"
-        elif self.user.datediff() == 0: #誕生日当日
+        elif diff == 0: #誕生日当日
             result += "今日はあなたの誕生日だね！\n"
             result += self.congrats()
-        elif self.user.datediff() == 1: #昨日が誕生日
+        elif diff == 1: #昨日が誕生日
             result += "昨日があなたの誕生日だったんだね！\n"
             result += self.congrats()
-        elif self.user.datediff() == 2: #一昨日が誕生日
+        elif diff == 2: #一昨日が誕生日
             result += "一昨日があなたの誕生日だったんだね！\n"
             result += self.congrats()
-        elif self.user.datediff() == -1: #明日が誕生日
+        elif diff == -1: #明日が誕生日
             result += 'あなたのお誕生日は明日だね！\n'
             result += "お誕生日をお祝いできるのを楽しみにしてるよ！\n"
         else:
-            result += f'あなたのお誕生日は{self.bd_str}だね！\n'
+            result += f'あなたのお誕生日は{self.user.bd_str}だね！\n'
             result += "お誕生日をお祝いできるのを楽しみにしてるよ！\n"
         return result
 
@@ -341,7 +449,7 @@ class HBDConversations:
         if self.user.get_bd() is None:
             result += "誕生日が読み取れなかったみたい。ごめんね。\n"
             result += "プロフ設定してから「登録して」って話しかけてね！"
-            print('**********登録時読み取り失敗**********')
+            log.info('**********登録時読み取り失敗**********')
         else:
             result += self.bdmessage()
         return result
@@ -373,100 +481,337 @@ class HBDConversations:
     def kora(self):
         return "@"+ADMIN+" ごめんにゃさい...処理を終了します"
     
+    # コマンドと返信を作るメソッド。複数含まれていたら上にあるものを優先する
+    COMMANDS = (
+        ('/ping', 'pong'),
+        ('/kora', 'kora'), #管理者のみ
+        ('/profile', 'profile'), #管理者のみ
+        ('祝って', 'onRequest'),
+        ('登録して', 'onRegiser'),
+        ('/help', 'help'),
+    )
+
+    @staticmethod
+    def commands_in(text) -> set:
+        '''textに含まれるコマンドを返します。'''
+        pattern = keyword_pattern(tuple(k for k, _ in HBDConversations.COMMANDS))
+        return set(pattern.findall(text))
+
+    #/profile
+    def profile(self):
+        return "@"+self.user.username+" プロファイルを取ります"
+
     def get_message(self, text):
-        if '/ping' in text:
-            return self.pong()
-        elif '/kora' in text and self.user.username == ADMIN:
-            return self.kora()
-        elif '祝って' in text:
-            return self.onRequest()
-        elif '登録して' in text:
-            return self.onRegiser()
-        elif '/help' in text:
-            return self.help()
-        else:
-            return ""
+        found = self.commands_in(text)
+        for command, method in self.COMMANDS:
+            if command not in found:
+                continue
+            if command in ('/kora', '/profile') and self.user.username != ADMIN:
+                continue
+            if command == '/profile' and self.user.host is not None:
+                continue #他のサーバーの同じ名前のユーザーは管理者ではない
+            return getattr(self, method)()
+        return ""
 
 class HBDBot:
     '''Botのメイン処理を担う'''
-    
-    def __init__(self):
+
+    # save()で保存する設定値
+    CONFIG_KEYS = (
+        'address',
+        'token',
+        'antenna_id',
+        'admin',
+        'target_reaction',
+        'threshold',
+        'refresh_rate',
+        'min_refresh_rate',
+        'max_refresh_rate',
+        'read_budget_pm',
+        'batch_size',
+        'async_intervals',
+        'queue_size',
+        'notification_workers',
+        'sources',
+        'keywords',
+        'greeting_window',
+        'warmup_lead',
+        'greeting_share',
+        'greeting_plan',
+        'metrics_port',
+        'metrics_interval',
+        'log_level',
+        'console_log_level',
+        'profile_cycles',
+        'profile_mode',
+    )
+    # 設定ファイルで変えても再起動するまで反映されない設定値
+    RESTART_KEYS = ('address', 'token', 'sources', 'queue_size', 'metrics_port')
+
+    def __init__(self, store=None, data_dir=None, coordinator=None):
+        '''store: 状態の保存先(StateStore)。省略時はSQLiteファイル
+        data_dir: 保存ファイルを置くフォルダ。省略時はこのスクリプトと同じフォルダ
+        coordinator: 複数のワーカーで分担するときの共有ファイル(Coordinator)'''
+        self.address = "misskey.io" #Misskeyのサーバー
         self.token = "" #Misskeyトークン
         self.antenna_id = ""
         self.admin = ""
         
         self.target_reaction = ":happy_birth_day__i@.:"#反応するリアクションの種類
         self.threshold = 1 #リアクションがいくつ以上ついていたら反応するか
-        self.refresh_rate = 20 #何秒ごとにアンテナを読み込むか
+        self.refresh_rate = 20 #何秒ごとにアンテナを読み込むか（起動時の値）
+        self.min_refresh_rate = 5 #新着が多いときの最短の読み込み間隔
+        self.max_refresh_rate = 120 #新着が無いときの最長の読み込み間隔
+        self.read_budget_pm = 60 #読み込みのAPI呼び出しを一分に何回までにするか
         self.batch_size = 30 #一度に読み込むノートの数
+        self.async_intervals = { #--asyncで起動したときの最短の読み込み間隔（秒）
+            'antenna': 2,
+            'ltl': 5,
+            'notification': 2,
+        }
+        self.queue_size = 200 #--asyncで読み込んでから処理するまでの待ち行列の長さ
+        self.notification_workers = 4 #通知の処理（ユーザー情報の取得と返信文の作成）を並行して行う数
+        self.sources = ['antenna', 'ltl', 'notification'] #読み込む対象。ワーカーで分担するときに絞る
+        self.keywords = ['誕生日', 'たんじょうび', 'たんおめ', '生誕', 'バースデ',
+                         'birthday', '🎂'] #LTLで判定するノートの語（アンテナの語に合わせる。大文字小文字を区別しない部分一致なので短い英字は避ける）。空なら絞り込まない
+        self.greeting_window = 1800 #0時のお祝いを何秒かけて送るか
+        self.warmup_lead = 900 #0時の何秒前から翌日のお祝いを準備するか。0なら準備しない
+        self.greeting_share = 0.6 #投稿の枠のうちお祝いに使ってよい割合。残りは返信用
+        self.greeting_plan = {} #今日のお祝いの予定（日付、件数、最後の送信予定時刻）
+        self.metrics_port = 9464 #メトリクスを公開するlocalhostのポート。0なら公開しない
+        self.metrics_interval = 300 #メトリクスの要約を何秒ごとに表示するか
+        self.log_level = 'INFO' #ログファイルに書き出す最低のレベル（DEBUGならノート一件ごと）
+        self.console_log_level = 'INFO' #画面に表示する最低のレベル
+        self.profile_cycles = 20 #SIGUSR1や/profileで何回分のループをプロファイルするか
+        self.profile_mode = 'sample' #'sample'（全スレッドのスタックを覗く）か'cprofile'
 
-        self.celeb_list = {} #お祝いしたユーザのIDと日時
-        self.bd_list = {} #フォロワーのIDと誕生日
-        self.responded = []
+        self.bd_list = BirthdayStore() #フォロワーのIDと誕生日、お祝いした日時
+        self.seen = SeenIds(clock=clock.time) #処理済みの通知とノートのID（アンテナとLTLで共有）
+        self.renote_stats = Counter() #リノート判定がどの段階で決まったか
 
-        self.notification_since_id = None
+        self.store = store
+        self.data_dir = data_dir
+        self.coordinator = coordinator
+        self.staged = {} #0時前に準備した翌日のお祝い（日付、[(ユーザー, 本文)]）
+        self.warmup_report = None #準備した人数と所要時間
+        self.scheduler = None #読み込み間隔の調整役
+        self.last_metrics = clock.now() #メトリクスの要約を表示した日時
         self.last_saved = None #データ保存した日時
-        print(VERSION)
+        self.config_file = data_path(CONFIG_FILE_NAME, data_dir)
+        self.config_mtime = None #設定ファイルを読んだときの更新時刻
+        self.reload_requested = False #SIGHUPを受けた
+        self.failed_notifications = {} #通知ID -> [通知, 失敗した回数, 次にやり直す時刻]
+        self.notification_retries = 5 #通知の処理を何回までやり直すか
+        self.failed_notes = {} #ノートID -> [ノート, 失敗した回数, 次にやり直す時刻]
+        self.failed_birthdays = {} #ユーザー -> [お祝いする日, 失敗した回数, 次にやり直す時刻]
+        self.profile_requested = False #SIGUSR1を受けた
+        self.profiler = Profiler(data_path(PROFILE_FILE_PREFIX, data_dir),
+                                 clock=clock.time)
+        self.snapshot_generation = None #スナップショットに書き出した保存先の版
+        self.scheduler_intervals = None #読み込み元の名前 -> 最短の読み込み間隔 を返す関数
+        log.info(VERSION)
         self.load()
 
     def __del__(self):
         pass #self.save()
 
     def save(self):
+        '''設定値を保存します。誕生日などのリストは変更の都度保存済みです。'''
         # トークン未設定の場合はロードに失敗したと考えるため、
         # セーブデータの上書きを避けて中断する
         if not self.token:
-            print('❗❗❗保存を中断します❗❗❗')
+            log.warning('❗❗❗保存を中断します❗❗❗')
+            return
+        for k in self.CONFIG_KEYS:
+            self.store.set_value(k, getattr(self, k))
+        self.store.flush()
+        self.save_snapshot()
+        self.last_saved = clock.now()
+
+    def save_snapshot(self):
+        '''誕生日の表をファイルに書き出します。前回から変わっていなければ何もしません。
+        次に起動したときはこれを読むだけで済みます。'''
+        generation = self.store.generation()
+        if generation is None or generation == self.snapshot_generation:
             return
-        file_path = __file__[:__file__.rfind('\\')+1] + FILE_NAME
-        self.notification_since_id = self.notif.since_id
-        dic = self.__dict__.copy()
-        del dic['last_saved']
-        del dic['mk']
-        del dic['antenna']
-        del dic['ltl']
-        del dic['notif']
-        JSONSave.save(
-            file_name=file_path,
-            **dic
-            )
-        self.last_saved = datetime.now()
+        self.bd_list.save_snapshot(data_path(SNAPSHOT_FILE_NAME, self.data_dir),
+                                   generation)
+        self.snapshot_generation = generation
 
     def load(self):
         """
         設定ファイルの読み込み
         """
-        file_path = __file__[:__file__.rfind('\\')+1] + FILE_NAME
-        dict = JSONSave.load(file_name=file_path)
-        if dict is not None:
-            for k, v in dict.items():
-                self.__dict__[k] = v
-            #データ読み込みチェック
-            if 'celeb_list' in dict:
-                print('祝ったリスト：', len(dict['celeb_list']))
-            if 'bd_list' in dict:
-                print('誕生日リスト：', len(dict['bd_list']))
-        self.last_saved = datetime.now()
-        if not self.token:
+        if self.store is None:
+            self.store = SQLiteStateStore(
+                data_path(STATE_FILE_NAME, self.data_dir))
+            if self.store.is_empty():
+                migrate_json(data_path(FILE_NAME, self.data_dir), self.store)
+        #誕生日の表は、保存先が前回書き出した時のままならスナップショットから読む
+        generation = self.store.generation()
+        bd_list = None
+        if generation is not None:
+            bd_list = BirthdayStore.load_snapshot(
+                data_path(SNAPSHOT_FILE_NAME, self.data_dir), generation)
+        dict = self.store.load(lists=bd_list is None)
+        cursors = dict.pop('cursors', {})
+        for id, at in dict.pop('seen', []):
+            self.seen.add(id, at)
+        for n in dict.pop('pending_notifications', []):
+            #前回やり直し待ちのまま終了した通知
+            self.seen.add('n:'+n['id'])
+            self.failed_notifications[n['id']] = [n, 0, 0.0]
+        if bd_list is None:
+            celeb_list = {k: clock.timestamp(v)
+                          for k, v in dict.pop('celeb_list', {}).items()}
+            bd_list = BirthdayStore(dict.pop('bd_list', {}), celeb_list)
+        else:
+            self.snapshot_generation = generation
+            log.info('スナップショットから読み込みました')
+        self.bd_list = bd_list
+        config = self.read_config() or {}
+        dict.update({k: v for k, v in config.items() if k in self.CONFIG_KEYS})
+        for k, v in dict.items():
+            self.__dict__[k] = v
+        botlog.set_levels(self.log_level, self.console_log_level)
+        #データ読み込みチェック
+        log.info('祝ったリスト：%d', len(self.bd_list.celebrated_since(1)))
+        log.info('誕生日リスト：%d', len(self.bd_list))
+        self.last_saved = clock.now()
+        wizard = not self.token
+        if wizard:
             self.init_wizard()
         else:
-            print('トークン：', self.token)
-            self.mk = Misskey_Antenna(i=self.token)
+            #ログはファイルに残るので、トークンは末尾だけ出す
+            log.info('トークン：…%s', self.token[-4:])
+            self.mk = Misskey_Antenna(self.address, i=self.token)
+        hosts.home = self.mk._Misskey__scheme+'://'+self.mk.address
         global ADMIN
         ADMIN = self.admin
 
         self.antenna = TimelineHandler(
             self.mk.notes_antennas,
             batch_size=self.batch_size,
+            on_commit=lambda id: self.store.set_cursor('antenna', id),
             antenna_id=self.antenna_id)
+        self.antenna.since_id = cursors.get('antenna')
         self.ltl = TimelineHandler(
             self.mk.notes_timeline,
-            batch_size=self.batch_size)
+            batch_size=self.batch_size,
+            on_commit=lambda id: self.store.set_cursor('ltl', id))
+        self.ltl.since_id = cursors.get('ltl')
         self.notif = NotificationHandler(
             self.mk, 
-            batch_size=self.batch_size)
-        if self.notification_since_id is not None:
-            self.notif.since_id = self.notification_since_id
+            batch_size=self.batch_size,
+            on_commit=lambda id: self.store.set_cursor('notification', id))
+        self.notif.since_id = cursors.get('notification')
+        use_clock(clock.time, clock.sleep) #SimulatedClockなら投稿の枠も早送りする
+        buckets = {'notes_create': notes_create_bucket,
+                   'notes_reactions_create': reactions_bucket}
+        if self.coordinator is not None:
+            #同じアカウントのワーカー同士で投稿の枠を分け合う
+            account = hashlib.sha1(self.token.encode()).hexdigest()[:8]
+            buckets = {k: self.coordinator.bucket(f'{b.name}/{account}', b.limits)
+                       for k, b in buckets.items()}
+        self.outbox = Outbox(
+            data_path(OUTBOX_FILE_NAME, self.data_dir),
+            self.mk,
+            buckets=buckets,
+            clock=clock.time)
+        self.outbox.paused = _silent_mode
+        self.follower_sync = FollowerSync(
+            self.mk,
+            known=lambda: self.bd_list,
+            update=self.sync_birthday,
+            remove=self.unregister,
+            on_cursor=lambda id: self.store.set_cursor('followers', id),
+            clock=clock.time)
+        self.notification_pool = KeyedPool(
+            self.prepare_reply,
+            self.apply_reply,
+            key=lambda n: MisskeyUser.key_from_dict(n['user']),
+            workers=self.notification_workers)
+        self.follower_sync.resume(cursors.get('followers'))
+        if wizard:
+            self.save()
+
+    def read_config(self) -> dict|None:
+        '''設定ファイルが前回読んだ後に書き換えられていたら、中身を返します。'''
+        try:
+            mtime = os.stat(self.config_file).st_mtime
+        except OSError:
+            return None
+        if mtime == self.config_mtime:
+            return None
+        self.config_mtime = mtime
+        return JSONSave.load(self.config_file)
+
+    def apply_config(self, config) -> dict:
+        '''設定値の辞書を、動いているBotにそのまま反映します。変わった値を返します。
+        読み込み位置、キャッシュ、お祝いの記録などは引き継ぎます。'''
+        changed = {}
+        for k, v in config.items():
+            if k not in self.CONFIG_KEYS:
+                log.warning('❗不明な設定値：%s', k)
+            elif getattr(self, k) != v:
+                changed[k] = v
+                setattr(self, k, v)
+        if not changed:
+            return changed
+        log.info('設定を反映：%s', changed)
+        for k in changed.keys() & set(self.RESTART_KEYS):
+            log.warning('❗再起動すると反映されます：%s', k)
+        self.configure(changed)
+        self.save()
+        return changed
+
+    def configure(self, changed):
+        '''変わった設定値をハンドラやスケジューラに反映します。
+        しきい値やリアクションなど、使うたびにselfから読む値は何もしなくても反映されます。'''
+        global ADMIN
+        ADMIN = self.admin
+        botlog.set_levels(self.log_level, self.console_log_level)
+        for handler in (self.antenna, self.ltl, self.notif):
+            handler.batch_size = self.batch_size
+            if 'refresh_rate' in changed:
+                handler.refresh_rate = self.refresh_rate
+        if self.antenna.param.get('antenna_id') != self.antenna_id:
+            #別のアンテナなので最新から読む
+            self.antenna.param['antenna_id'] = self.antenna_id
+            self.antenna.since_id = None
+            self.store.set_cursor('antenna', None)
+        if 'notification_workers' in changed:
+            #--asyncでは再起動すると反映されます
+            self.notification_pool.resize(self.notification_workers)
+        if self.scheduler is not None:
+            self.scheduler.budget_pm = self.read_budget_pm
+            for name, min_interval in self.scheduler_intervals().items():
+                update = dict(min_interval=min_interval,
+                              max_interval=self.max_refresh_rate,
+                              batch_size=self.batch_size)
+                if 'refresh_rate' in changed:
+                    update['interval'] = self.refresh_rate
+                self.scheduler.update(name, **update)
+
+    def watch_signals(self):
+        '''SIGHUPを受けたら設定ファイルを読み直し、SIGUSR1を受けたらプロファイルを取るようにします。
+        POSIXのみ。メインスレッドから呼びます。'''
+        if hasattr(signal, 'SIGHUP'):
+            signal.signal(signal.SIGHUP,
+                          lambda signum, frame: setattr(self, 'reload_requested', True))
+        if hasattr(signal, 'SIGUSR1'):
+            signal.signal(signal.SIGUSR1,
+                          lambda signum, frame: setattr(self, 'profile_requested', True))
+
+    def start_profile(self, cycles=None, mode=None):
+        '''これからcycles回のループ（--asyncではhousekeepingの回数）をプロファイルします。
+        終わったらファイルに書き出します。'''
+        cycles = cycles or self.profile_cycles
+        mode = mode or self.profile_mode
+        if self.profiler.start(cycles, mode):
+            log.info('プロファイル開始：%s, %d回', mode, cycles)
+        else:
+            log.warning('❗プロファイルを開始できません：%s（実行中か、不明なモード）', mode)
 
     def init_wizard(self):
         """
@@ -476,13 +821,13 @@ class HBDBot:
         self.token = input('Misskeyのトークンを入力してください。'
                            '空のままEnterで新規発行>>>')
         if not self.token:
-            auth = MiAuth(name=__file__[__file__.rfind('\\')+1:])
+            auth = MiAuth(self.address, name=__file__[__file__.rfind('\\')+1:])
             url = auth.generate_url()
             print('トークンの新規発行を行います。'
                   'URLをブラウザで開いて下さい。',url)
             input('認証が完了したらEnterで続行>>>')
             self.token = auth.check()
-        self.mk = Misskey_Antenna(i=self.token)
+        self.mk = Misskey_Antenna(self.address, i=self.token)
         try:
             userinfo = self.mk.i()
         except exceptions.MisskeyAuthorizeFailedException:
@@ -520,187 +865,709 @@ class HBDBot:
         text = note['text'][:30].replace('\n', '') if note['text'] is not None else ''
         return dt_str+username+'\t'+text
     
+    def mark_seen(self, id, persist=True) -> bool:
+        '''IDを処理済みにします。初めてのIDならTrueを返します。
+        persist=Falseなら保存はせず、処理し終えてからpersist_seen()で保存します。'''
+        if not self.seen.add(id):
+            return False
+        if self.coordinator is not None and not self.coordinator.claim_seen(id):
+            return False #他のワーカーが処理済み
+        if persist:
+            self.persist_seen(id)
+        return True
+
+    def persist_seen(self, id):
+        '''処理済みのIDを保存します。再起動しても同じものは処理しません。'''
+        self.store.add_seen(id, self.seen.clock())
+
+    def claim(self, key) -> bool:
+        '''今日のkeyのお祝いを自分が行うことにします。
+        ワーカーで分担していて、他のワーカーが先に行っていたらFalseを返します。'''
+        if self.coordinator is None:
+            return True
+        return self.coordinator.claim(key, clock.today.isoformat())
+
+    @timed('check_note')
     def check_note(self, note):
         if note['user']['username'] == 'HBDBot':
             return
+        #アンテナとLTLの両方に流れてきたノートは一度だけ判定する。
+        #リノートは元のノートとは別に数え、後からリアクションが増えていたら判定し直す
+        if not self.mark_seen(note['id']):
+            return
+        self.judge_note(note)
+
+    def judge_note(self, note):
+        '''処理済みにしたノートを判定し、お祝いするならリノートを予約します。'''
+        fetched = note
         #流れてきたのがリノートの場合
+        prefix = ''
         if 'renote' in note:
-            print('RN:', end='')
+            prefix = 'RN:'
             note = note['renote']
-        user = MisskeyUser.from_dict(note['user'])
-        if user is None:
+        try:
+            with stage_seconds.time(stage='decide'):
+                renote = self.is_to_renote(note)
+        except RequestException as e:
+            self.retry_note(fetched, e) #misskey.ioとの通信の失敗。後で判定し直す
             return
-        if user.is_birthday():
-            note['birthday'] = None
-        print(self.summarize_note(note), note['reactions'])
-        if self.is_to_renote(note, user):
-            self.mk.notes_reactions_create(note['id'], self.target_reaction)
-            self.mk.notes_create(renote_id=note['id'])
-            print('↑↑↑↑↑↑↑↑🎂 RN 🎂↑↑↑↑↑↑↑↑')
-            self.celeb_list[user.name_w_host] = datetime.now().isoformat()
-
-    def antenna_search(self):
-        atl = self.antenna.get_timeline()
+        log.debug('%s%s %s', prefix, lazy(self.summarize_note, note), note['reactions'])
+        if renote:
+            key = MisskeyUser.key_from_dict(note['user'])
+            if self.claim(key):
+                self.outbox.put('reaction', note['id'], 'notes_reactions_create',
+                                note_id=note['id'], reaction=self.target_reaction)
+                self.outbox.put('renote', note['id'], 'notes_create',
+                                renote_id=note['id'])
+                log.info('%s\n↑↑↑↑↑↑↑↑🎂 RN 🎂↑↑↑↑↑↑↑↑', lazy(self.summarize_note, note),
+                         extra={'note': note['id'], 'user': key})
+            else:
+                log.info('（他のワーカーがお祝い済み）%s', key)
+            self.celebrate(key)
+
+    def celebrate(self, key):
+        '''お祝いしたユーザーとして記録します。'''
+        at = clock.time()
+        self.bd_list.celebrate(key, at)
+        self.store.set_celebrated(key, clock.at(at).isoformat())
+
+    def antenna_search(self, wait=True):
+        '''アンテナを読み込んでチェック。(件数, 満杯だったか)を返します。'''
+        with stage_seconds.time(stage='fetch'):
+            atl = self.antenna.get_timeline(wait)
         if not atl:
-            print('アンテナに新着ノートはありません。')
-            return
-        print(f'アンテナ：{len(atl)}/{self.batch_size}件のノートを読み込み。。。')
+            log.debug('アンテナに新着ノートはありません。')
+            return 0, False
+        log.debug('アンテナ：%d/%d件のノートを読み込み。。。（積み残し%d件）',
+                  len(atl), self.batch_size, self.antenna.backlog)
         for note in atl:
             self.check_note(note)
-        print()
+        self.antenna.commit(self.antenna.since_id)
+        return len(atl), not self.antenna.caught_up
 
-    def ltl_search(self):
-        ltl = self.ltl.get_timeline()
+    def ltl_search(self, wait=True):
+        '''LTLを読み込んでチェック。(件数, 満杯だったか)を返します。'''
+        with stage_seconds.time(stage='fetch'):
+            ltl = self.ltl.get_timeline(wait)
         if not ltl:
-            print('LTLに新着ノートはありません。')
-            return
-        print(f'LTL：{len(ltl)}/{self.batch_size}件のノートを読み込み。。。')
+            log.debug('LTLに新着ノートはありません。')
+            return 0, False
+        log.debug('LTL：%d/%d件のノートを読み込み。。。（積み残し%d件）',
+                  len(ltl), self.batch_size, self.ltl.backlog)
         for note in ltl:
+            self.check_ltl_note(note)
+        self.ltl.commit(self.ltl.since_id)
+        return len(ltl), not self.ltl.caught_up
+
+    def check_ltl_note(self, note):
+        '''LTLのノートをprefilter()で絞り込んでからチェック。'''
+        if self.prefilter(note):
             self.check_note(note)
-        print()
+        else:
+            self.renote_stats['reject:prefilter'] += 1
 
-    def is_to_renote(self, note, user) -> bool:
+    def prefilter(self, note) -> bool:
+        '''LTLのノートがリノートの対象になり得るかを、通信せずにすぐ調べます。
+        - target_reactionがついている
+        - 本文にkeywordsかtarget_reactionの絵文字が含まれる
+        - 今日が誕生日のフォロワーのノート
+        のどれでもなければFalseを返します。LTLはアンテナと違って絞り込まれていないので、
+        ほとんどのノートをここで落とします。'''
+        if not self.keywords:
+            return True
+        note = note.get('renote') or note
+        if self.target_reaction in note['reactions']:
+            return True
+        if note['text'] and keyword_pattern(
+                (*self.keywords, self.target_reaction.replace('@.', '')),
+                ignore_case=True).search(note['text']):
+            return True
+        bd = self.bd_list.get(MisskeyUser.key_from_dict(note['user']))
+        return bd is not None and datediff(bd, clock.today) == 0
+
+    # リノート判定の段階。通信の要らない安いものから順に並べ、
+    # 誕生日の確認（ユーザー情報の取得）は最後に回す。
+    RENOTE_STAGES = (
+        'software',
+        'created_today',
+        'cw',
+        'sensitive',
+        'celebrated_today',
+        'reaction',
+        'birthday',
+    )
+
+    @timed('is_to_renote')
+    def is_to_renote(self, note) -> bool:
         '''
         渡されたノートがリノート対象かどうかを判定します。
-        - 投稿者がお誕生日！かつまだお祝いしていない（確定リノート）
-        - target_reactionがthreshold個以上ついている
-        - もしくは本文にtarget_reactionが含まれる
-        - 投稿日が今日
-        - celeb_listにユーザIDが含まれていない
-        - celeb_listに含まれる場合、お祝い日時が今日ではない
-        - CWとNSFWがついていない
+        RENOTE_STAGESの順に判定し、どこかで決まればそこで打ち切ります。
+        - 投稿者のサーバーがMisskeyでない場合は対象外
+        - 投稿日が今日でない場合は対象外
+        - CWかNSFWがついている場合は対象外
+        - 今日すでにお祝いしたユーザーは対象外
+        - target_reactionがthreshold個以上ついていればリノート
+        - 投稿者がお誕生日！かつまだお祝いしていなければリノート
+        どの段階で決まったかはrenote_statsに数えます。
         '''
-        if user.is_birthday() and \
-            user.name_w_host not in self.celeb_list:
-                return True
-        if self.target_reaction not in note['reactions'] or \
-            note['reactions'][self.target_reaction] < self.threshold:
+        for stage in self.RENOTE_STAGES:
+            result = getattr(self, '_stage_'+stage)(note)
+            if result is None:
+                continue
+            self.renote_stats[('accept:' if result else 'reject:')+stage] += 1
+            return result
+        self.renote_stats['reject:end'] += 1
+        return False
+
+    def _stage_software(self, note):
+        if not MisskeyUser.is_supported(note['user']):
             return False
-        dt = datetime.fromisoformat(note['createdAt'])+timedelta(hours=9)
-        if dt.date() != date.today():
+
+    def _stage_created_today(self, note):
+        if clock.date_of(note['createdAt']) != clock.today:
             return False
-        if user.name_w_host in self.celeb_list:
-            dt = datetime.fromisoformat(self.celeb_list[user.name_w_host])
-            if dt.date() == date.today():
-                return False
+
+    def _stage_cw(self, note):
         if note['cw'] is not None:
             return False
+
+    def _stage_sensitive(self, note):
         if note['files'] is not None:
             for file in note['files']:
                 if 'isSensitive' in file and file['isSensitive']:
                     return False
+
+    def _stage_celebrated_today(self, note):
+        at = self.bd_list.celebrated_at(MisskeyUser.key_from_dict(note['user']))
+        if at is not None and at >= clock.today_start:
+            return False
+
+    def _stage_reaction(self, note):
+        if note['reactions'].get(self.target_reaction, 0) >= self.threshold:
+            return True
+
+    def _stage_birthday(self, note):
+        #ここで初めてユーザー情報を取得する
+        if self.bd_list.is_celebrated(MisskeyUser.key_from_dict(note['user'])):
+            return False
+        try:
+            user = MisskeyUser.from_dict(note['user'])
+        except HostUnavailable:
+            return False
+        if user is None or not user.is_birthday():
+            return False
+        note['birthday'] = None
         return True
 
     def register(self, user: MisskeyUser):
         '''フォロワーIDと誕生日をリストに格納'''
         if not user.bd:
             return
-        host = "@"+user.host if user.host is not None else ''
-        self.bd_list[user.username+host] = user.bd
+        self.set_birthday(user.name_w_host, user.bd)
+        self.follower_sync.registered(user.name_w_host)
 
-    def notification_check(self):
-        '''通知を取得してチェック'''
-        notifications = self.notif.get_notification()
-        if not notifications:
-            print('新着のお知らせはありません。')
+    def set_birthday(self, key, bd) -> bool:
+        '''誕生日リストを更新します。変更があったかどうかを返します。'''
+        if self.bd_list.get(key) == bd:
+            return False
+        self.bd_list[key] = bd
+        self.store.set_birthday(key, bd)
+        return True
+
+    def sync_birthday(self, key, bd) -> bool:
+        '''フォロワー一覧で見つけた誕生日を反映します。'''
+        if not self.set_birthday(key, bd):
+            return False
+        user_cache.invalidate(key)
+        return True
+
+    def unregister(self, key):
+        '''誕生日リストから外します。'''
+        if self.bd_list.pop(key, None) is None:
             return
-        print('新着のお知らせは', len(notifications), '件です。')
-        for n in notifications:
-            if n['id'] in self.responded:
-                print('（済）',end='')
-            print(n['id'],n['type'],
-                n['user']['name']+"\t"+n['user']['username'],
-                n['text'][:30] if 'text' in n else '')
-            if n['id'] in self.responded:
-                # print("____skip____")
-                continue
-            if 'user' not in n:
-                continue
-            self.responded.append(n['id'])
-            if 'user' not in n:
-                continue
+        self.store.delete_birthday(key)
+        user_cache.invalidate(key)
+
+    def notification_check(self, wait=True):
+        '''通知を取得してチェック。(件数, 満杯だったか)を返します。'''
+        with stage_seconds.time(stage='fetch'):
+            notifications = self.notif.get_notification(wait)
+        if not notifications:
+            log.debug('新着のお知らせはありません。')
+            return 0, False
+        log.debug('新着のお知らせは%d件です。', len(notifications))
+        self.notification_pool.run(
+            [n for n in notifications if self.accept_notification(n)])
+        self.notif.commit(self.notif.since_id)
+        return len(notifications), len(notifications) >= self.notif.batch_size
+
+    def accept_notification(self, n) -> bool:
+        '''通知を処理済みにします。新しく処理する通知ならTrueを返します。'''
+        if 'user' not in n:
+            return False
+        #保存は返信を予約してから（apply_reply()）。その前に落ちたら読み直して処理する
+        if not self.mark_seen('n:'+n['id'], persist=False):
+            log.debug('（済）%s %s', n['id'], n['type'])
+            return False
+        log.debug('%s %s %s\t%s %s', n['id'], n['type'],
+                  n['user']['name'], n['user']['username'],
+                  n['text'][:30] if 'text' in n else '')
+        # 登録とフォローのときは最新のプロフィールを読み直す
+        if n['type'] == 'follow' or \
+                ('note' in n and n['note']['text'] is not None
+                 and '登録して' in HBDConversations.commands_in(n['note']['text'])):
+            user_cache.invalidate(MisskeyUser.key_from_dict(n['user']))
+        return True
+
+    def prepare_reply(self, n):
+        '''ユーザー情報を取得して返信文を作ります。(ユーザー, 返信文)を返します。
+        Botの状態には触らないので、別のスレッドで呼べます。'''
+        try:
             user = MisskeyUser.from_dict(n['user'])
-            if user is None:
+        except HostUnavailable:
+            return None
+        if user is None:
+            return None
+        cv = HBDConversations(user)
+        if n['type'] == "mention" or n['type'] == "reply":
+            return user, cv.get_message(n['note']['text'])
+        elif n['type'] == 'follow':
+            return user, cv.onFollow()
+        return user, None
+
+    def apply_reply(self, n, prepared):
+        '''prepare_reply()の結果から返信を予約し、誕生日を登録します。
+        予約し終えたら通知を処理済みとして保存します。'''
+        if isinstance(prepared, Exception):
+            self.retry_notification(n, prepared)
+            return
+        try:
+            self._apply_reply(n, prepared)
+        finally:
+            self.persist_seen('n:'+n['id']) #/koraで止めたときも
+
+    def _apply_reply(self, n, prepared):
+        if prepared is None:
+            return
+        user, rep = prepared
+        if n['type'] == "mention" or n['type'] == "reply":
+            log.info('Message: %s', lazy(self.summarize_note, n['note']))
+            id = n['note']['id']
+            text = n['note']['text']
+            # 他サーバーにリプライしようとするとエラーが出るので
+            # 緊急措置！！！
+            if user.host is not None:
+                id = None
+            if rep:
+                self.outbox.put('reply', n['id'], 'notes_create', text=rep,
+                                reply_id=id, visibility=NoteVisibility.FOLLOWERS)
+                log.info('Reply:%s', rep[:100], extra={'user': user.name_w_host})
+                commands = HBDConversations.commands_in(text)
+                if '/kora' in commands and user.username == self.admin:
+                    raise KeyboardInterrupt #強制終了
+                elif '/profile' in commands and user.username == self.admin \
+                        and user.host is None:
+                    #例：/profile 30 cprofile
+                    cycles = re.search(r'/profile\s+(\d+)', text)
+                    self.start_profile(int(cycles[1]) if cycles else None,
+                                       'cprofile' if 'cprofile' in text else None)
+                elif '登録して' in commands:
+                    self.register(user)
+            else:
+                log.info('hmm...?')
+                self.outbox.put('reaction', n['note']['id'],
+                                'notes_reactions_create',
+                                note_id=n['note']['id'],
+                                reaction=":_question_mark:")
+        elif n['type'] == 'follow':
+            self.outbox.put('reply', n['id'], 'notes_create', text=rep)
+            log.info('🎉🎉🎉Follow:%s', rep[:100], extra={'user': user.name_w_host})
+            self.register(user)
+
+    def retry_notification(self, n, error):
+        '''処理に失敗した通知（misskey.ioとの通信の失敗など）を後でやり直します。
+        読み込み位置は先に進むので、やり直し待ちの通知は保存しておきます。'''
+        entry = self.failed_notifications.setdefault(n['id'], [n, 0, 0.0])
+        entry[1] += 1
+        if entry[1] > self.notification_retries:
+            log.warning('❗❗❗通知の処理をあきらめます❗❗❗ %s %s', n['id'], error)
+            del self.failed_notifications[n['id']]
+            self.persist_seen('n:'+n['id'])
+            self.save_failed_notifications()
+            return
+        if entry[1] == 1:
+            self.save_failed_notifications()
+        entry[2] = clock.time() + 30*entry[1] #回数に応じて間をあける
+        log.warning('❗通知の処理に失敗、後でやり直します（%d回目）：%s %s',
+                    entry[1], n['id'], error)
+
+    def retry_note(self, note, error):
+        '''判定の途中で通信に失敗したノートを後で判定し直します。'''
+        entry = self.failed_notes.setdefault(note['id'], [note, 0, 0.0])
+        entry[1] += 1
+        if entry[1] > self.notification_retries:
+            log.warning('❗❗❗ノートの判定をあきらめます❗❗❗ %s %s', note['id'], error)
+            del self.failed_notes[note['id']]
+            return
+        entry[2] = clock.time() + 30*entry[1]
+        log.warning('❗ノートの判定に失敗、後でやり直します（%d回目）：%s %s',
+                    entry[1], note['id'], error)
+
+    def retry_notes(self):
+        '''やり直す時刻になったノートをもう一度判定します。'''
+        now = clock.time()
+        for id, (note, _, at) in list(self.failed_notes.items()):
+            if at > now:
                 continue
-            cv = HBDConversations(user)
-
-            if n['type'] == "mention" or n['type'] == "reply":
-                print("Message:", self.summarize_note(n['note']))
-                id = n['note']['id']
-                text = n['note']['text']
-                rep = cv.get_message(text)
-                # 他サーバーにリプライしようとするとエラーが出るので
-                # 緊急措置！！！
-                if user.host is not None:
-                    id = None
-                if rep:
-                    self.mk.notes_create(rep, reply_id=id, visibility=NoteVisibility.FOLLOWERS)
-                    print('Reply:'+rep[:100])
-                    if '/kora' in text and user.username == self.admin:
-                        raise KeyboardInterrupt #強制終了
-                    elif '登録して' in text:
-                        self.register(user)
-                else:
-                    print('hmm...?')
-                    self.mk.notes_reactions_create(id, ":_question_mark:")
-            elif n['type'] == 'follow':
-                rep = cv.onFollow()
-                self.mk.notes_create(rep)
-                print('🎉🎉🎉Follow:'+rep[:100])
-                self.register(user)
+            self.judge_note(note)
+            entry = self.failed_notes.get(id)
+            if entry is not None and entry[2] <= now:
+                del self.failed_notes[id]
+
+    def retry_notifications(self):
+        '''やり直す時刻になった通知をもう一度処理します。'''
+        now = clock.time()
+        due = [n for n, _, at in self.failed_notifications.values() if at <= now]
+        self.notification_pool.run(due)
+        for n in due:
+            #また失敗したら、やり直す時刻がnowより後に付け直されている
+            entry = self.failed_notifications.get(n['id'])
+            if entry is not None and entry[2] <= now:
+                del self.failed_notifications[n['id']]
+        self.save_failed_notifications()
+
+    def save_failed_notifications(self):
+        '''やり直し待ちの通知を保存します。読み込み位置は先に進んでいるので、
+        再起動したときはここから読み直してやり直します。'''
+        self.store.set_value('pending_notifications',
+                             [n for n, _, _ in self.failed_notifications.values()])
 
+    @timed('midnight')
     def midnight(self):
         '''日付が変わったときの処理'''
-        print('--------------------')
-        print(date.today())
-        print('--------------------')
+        log.info('--------------------\n%s\n--------------------', clock.today)
         self.save()
 
-        self.celeb_list = {u:t for u,t in self.celeb_list.items()
-                           if not has_past(t, hours=1)}
-        print('リストクリア。残り：', len(self.celeb_list))
+        for u in self.bd_list.prune_celebrated(clock.time() - 3600):
+            self.store.delete_celebrated(u)
+        log.info('リストクリア。残り：%d', len(self.bd_list.celebrated_since(1)))
+
+        if self.staged.get('date') == clock.today.isoformat():
+            greetings = self.staged['greetings'] #0時前に準備済み
+        else:
+            self.warmup_report = None
+            bd_users = self.resolve_birthdays(clock.today)
+            log.info('今日が誕生日のフォロワー：%d', len(bd_users))
+            greetings = [(u.name_w_host, HBDConversations(u).onRequest())
+                         for u in bd_users]
+        self.staged = {}
+        self.plan_greetings(greetings)
+
+    def resolve_birthdays(self, day) -> list:
+        '''dayが誕生日の人を索引から選び、プロフィールを確認し直して返します。
+        通信に失敗した人はfailed_birthdaysに入れ、housekeeping()でやり直します。'''
+        bd_users, failed = self._resolve(self.bd_list.on(day), day)
+        for u in failed:
+            self.retry_birthday(u, day)
+        return bd_users
 
+    def _resolve(self, users, day) -> tuple:
+        '''usersのプロフィールを取得し直します。
+        (dayが誕生日の人, 通信に失敗した人) を返します。'''
         bd_users = []
-        for u, d in self.bd_list.items():
+        def resolve(u):
             try:
-                mu = MisskeyUser(u)
-            except exceptions.MisskeyAPIException:
-                continue
-            if mu.is_birthday():
+                return MisskeyUser(u)
+            except (exceptions.MisskeyAPIException, HostUnavailable):
+                return None
+        failed = []
+        def done(u, mu):
+            if isinstance(mu, Exception):
+                failed.append(u) #misskey.ioとの通信の失敗
+                return
+            if mu is None:
+                return
+            user_cache.put(u, mu)
+            if mu.bd != self.bd_list.get(u):
+                self.register(mu) #誕生日が変更されていた
+            if mu.is_birthday(day):
                 bd_users.append(mu)
-        for u in bd_users:
-            cv = HBDConversations(u)
-            message = cv.onRequest()
-            self.mk.notes_create(message)
-            # self.celeb_list[u.name_w_host]=datetime.now().isoformat()
+        pool = KeyedPool(resolve, done, key=lambda u: u,
+                         workers=self.notification_workers)
+        try:
+            pool.run(users)
+        finally:
+            pool.shutdown()
+        return bd_users, failed
+
+    def retry_birthday(self, u, day):
+        '''プロフィールを取得できなかった誕生日の人を後で確認し直します。'''
+        entry = self.failed_birthdays.setdefault(u, [day, 0, 0.0])
+        entry[1] += 1
+        if entry[1] > self.notification_retries:
+            log.warning('❗❗❗お祝いできませんでした❗❗❗ %s', u)
+            del self.failed_birthdays[u]
+            return
+        entry[2] = clock.time() + 30*entry[1]
+        log.warning('❗ユーザー情報の取得に失敗、後でやり直します（%d回目）：%s',
+                    entry[1], u)
+
+    def retry_birthdays(self):
+        '''やり直す時刻になった人のプロフィールを確認し、
+        今日が誕生日ならお祝いを、明日なら準備に加えます。'''
+        now = clock.time()
+        days = {}
+        for u, (day, _, at) in self.failed_birthdays.items():
+            if at <= now:
+                days.setdefault(day, []).append(u)
+        for day, users in days.items():
+            bd_users, failed = self._resolve(users, day)
+            for u in users:
+                if u not in failed:
+                    del self.failed_birthdays[u]
+            for u in failed:
+                self.retry_birthday(u, day)
+            greetings = [(u.name_w_host, HBDConversations(u, day).onRequest())
+                         for u in bd_users]
+            if day == clock.today:
+                self.plan_greetings(greetings, add=True)
+            elif self.staged.get('date') == day.isoformat():
+                self.staged['greetings'] += greetings
+
+    def warm_up(self):
+        '''翌日が誕生日の人のプロフィールを確認し、お祝いの本文を作っておきます。
+        0時にはこれを送信予約するだけで済みます。'''
+        started = time.perf_counter()
+        tomorrow = clock.today + timedelta(days=1)
+        bd_users = self.resolve_birthdays(tomorrow)
+        self.staged = {
+            'date': tomorrow.isoformat(),
+            'greetings': [(u.name_w_host, HBDConversations(u, tomorrow).onRequest())
+                          for u in bd_users]}
+        self.save()
+        self.warmup_report = {
+            'date': tomorrow.isoformat(),
+            'staged': len(bd_users),
+            'seconds': round(time.perf_counter() - started, 2)}
+        log.info('お祝いの準備：%s', self.warmup_report)
+
+    def plan_greetings(self, greetings, add=False):
+        '''お祝いの投稿をgreeting_windowの間に散らして送信予約します。
+        greetings: [(ユーザー, 本文)]
+        add=Trueなら今日の予定の後ろに足します（やり直しで確認できた人）。
+        返信の分の枠を残すため、投稿の枠のgreeting_shareまでしか使いません。'''
+        #ワーカーで分担しているときは、他のワーカーがお祝いする人を除く
+        greetings = [(u, text) for u, text in greetings
+                     if self.claim('greeting:'+u)]
+        min_gap = 1 / (notes_create_bucket.sustained_rate()*self.greeting_share)
+        start, window = clock.time(), self.greeting_window
+        if add and self.greeting_plan.get('last_at'):
+            start = max(start, clock.timestamp(self.greeting_plan['last_at']) + min_gap)
+            window = 0
+        times = spread(len(greetings), start, window, min_gap)
+        for (u, text), at in zip(greetings, times):
+            self.outbox.put('greeting', f'{u}/{clock.today}',
+                            'notes_create', not_before=at, priority=1,
+                            text=text)
+        if add and self.greeting_plan.get('date') == clock.today.isoformat():
+            if times:
+                self.greeting_plan['planned'] += len(times)
+                self.greeting_plan['last_at'] = clock.at(times[-1]).isoformat()
+                log.info('お祝いの予定に追加：%s', self.greeting_plan)
+            return
+        self.greeting_plan = {
+            'date': clock.today.isoformat(),
+            'planned': len(times),
+            'last_at': clock.at(times[-1]).isoformat()
+                       if times else None,
+            'warmup': self.warmup_report}
+        log.info('お祝いの予定：%s', self.greeting_plan)
+
+    def greeting_report(self) -> dict:
+        '''今日のお祝いの予定数と送信済み・未送信の数を返します。'''
+        pending = self.outbox.count_pending('greeting')
+        dropped = self.outbox.dropped_by_kind['greeting']
+        return dict(self.greeting_plan,
+                    pending=pending,
+                    dropped=dropped,
+                    sent=self.greeting_plan.get('planned', 0) - pending - dropped)
+
+    def housekeeping(self):
+        '''日付の変更と一時間ごとの自動保存、フォロワーの同期'''
+        clock.tick()
+        if (file_name := self.profiler.cycle()) is not None:
+            log.info('プロファイルを書き出しました：%s', file_name)
+        if self.profile_requested:
+            self.profile_requested = False
+            self.start_profile()
+        if self.reload_requested:
+            self.reload_requested = False
+            self.config_mtime = None #書き換えられていなくても読み直す
+        if (config := self.read_config()) is not None:
+            self.apply_config(config)
+        if self.last_saved.date() != clock.today:
+            if self.staged.get('date') != clock.today.isoformat():
+                clock.sleep(60)
+            self.midnight()
+        elif self.warmup_lead and not self.staged and not _silent_mode \
+                and clock.today_start + 24*3600 - clock.time() <= self.warmup_lead:
+            self.warm_up()
+        if self.failed_notifications and not _silent_mode:
+            self.retry_notifications()
+        if self.failed_notes and not _silent_mode:
+            self.retry_notes()
+        if self.failed_birthdays and not _silent_mode:
+            self.retry_birthdays()
+        if self.follower_sync.due() and not _silent_mode:
+            try:
+                self.follower_sync.step()
+            except (RequestException, exceptions.MisskeyAPIException) as e:
+                log.warning('❗❗❗フォロワー同期に失敗❗❗❗ %s', e)
+                self.follower_sync.next_due += self.follower_sync.page_interval
+        if has_past(self.last_metrics, seconds=self.metrics_interval):
+            log.info('____METRICS: %s', metrics.registry.summary())
+            self.last_metrics = clock.now()
+        if has_past(self.last_saved, hours=1):
+            log.info('____AUTOSAVE: %s ____', clock.now())
+            before = self.seen.prune()
+            self.store.prune_seen(before)
+            if self.coordinator is not None:
+                self.coordinator.prune(before)
+            self.save()
+            log.info('ユーザーキャッシュ：%s', user_cache.stats())
+            log.info('サーバー：%s', hosts.stats())
+            log.info('リノート判定：%s', dict(self.renote_stats))
+            log.info('処理済みID：%s', self.seen.stats())
+            log.info('送信待ち：%s', self.outbox.stats())
+            log.info('お祝い：%s', self.greeting_report())
+            if self.scheduler is not None:
+                log.info('読み込み間隔：%s', self.scheduler.intervals())
+            self.outbox.compact()
+
+    def make_scheduler(self, min_intervals) -> PollScheduler:
+        '''読み込み元ごとの間隔を新着の多さに合わせて調整するスケジューラを作ります。
+        min_intervals: 読み込み元の名前 -> 最短の読み込み間隔（秒） の辞書を返す関数。
+            設定を読み直したときにも呼びます'''
+        self.scheduler_intervals = min_intervals
+        self.scheduler = PollScheduler(budget_pm=self.read_budget_pm,
+                                       clock=clock.time)
+        for name, min_interval in min_intervals().items():
+            self.scheduler.add(name,
+                               min_interval,
+                               self.max_refresh_rate,
+                               self.batch_size,
+                               initial=self.refresh_rate)
+        return self.scheduler
+
+    def start_metrics(self):
+        '''メトリクスの集計対象を登録し、localhostで公開します。'''
+        r = metrics.registry
+        r.gauge('hbdbot_outbox_pending', lambda: len(self.outbox),
+                'Posts and reactions waiting to be sent')
+        r.gauge('hbdbot_seen_ids', lambda: len(self.seen),
+                'Remembered processed ids')
+        r.gauge('hbdbot_user_cache', lambda: {
+                    'hits': user_cache.hits,
+                    'misses': user_cache.misses,
+                    'evictions': user_cache.evictions,
+                    'size': len(user_cache)},
+                'User cache counters')
+        r.gauge('hbdbot_ratelimit_denied', lambda: {
+                    name: b.denied for name, b in ratelimit_buckets.items()},
+                'Requests refused by the rate limiter')
+        r.gauge('hbdbot_ratelimit_wait_seconds', lambda: {
+                    name: b.waited for name, b in ratelimit_buckets.items()},
+                'Seconds spent waiting on the rate limiter')
+        r.gauge('hbdbot_poll_interval_seconds',
+                lambda: self.scheduler.intervals() if self.scheduler else {},
+                'Current polling interval per source')
+        r.gauge('hbdbot_renote_decisions', lambda: dict(self.renote_stats),
+                'Renote decisions by pipeline stage')
+        if self.metrics_port:
+            try:
+                r.serve(self.metrics_port)
+            except OSError as e:
+                log.warning('❗❗❗メトリクスを公開できません❗❗❗ %s', e)
 
     def mainloop(self):
+        self.start_metrics()
+        self.watch_signals()
+        sources = {'antenna': self.antenna_search,
+                   'ltl': self.ltl_search,
+                   'notification': self.notification_check}
+        sources = {k: v for k, v in sources.items() if k in self.sources}
+        handlers = {'antenna': self.antenna, 'ltl': self.ltl,
+                    'notification': self.notif}
+        scheduler = self.make_scheduler(
+            lambda: {name: self.min_refresh_rate for name in sources})
         try:
             while True:
-                if self.last_saved.date() != date.today():
-                    time.sleep(60)
-                    self.midnight()
-                if has_past(self.last_saved, hours=1):
-                    print('\n____AUTOSAVE:',datetime.now(),'____')
-                    self.responded = self.responded[-100:]
-                    self.antenna.since_id = None
-                    self.ltl.since_id = None
-                    self.save()
-                self.antenna_search()
-                self.ltl_search()
-                self.notification_check()
+                self.housekeeping()
+                for name in scheduler.due():
+                    count, full = sources[name](wait=False)
+                    scheduler.report(name, count, full, handlers[name].calls)
+                self.outbox.drain()
                 if _silent_mode:
-                    print('❗❗❗サイレントモードで起動中❗❗❗')
+                    log.warning('❗❗❗サイレントモードで起動中❗❗❗')
                     break
-                time.sleep(self.refresh_rate)
+                wait = scheduler.time_until_next()
+                if self.outbox:
+                    wait = min(wait, 5) #送信待ちがあるときは早めに戻ってくる
+                clock.sleep(wait)
         except KeyboardInterrupt:
             pass
         except Exception as e:
+            log.exception('ぐえー')
             self.mk.dm_admin("ぐえー\n"+str(e))
+            return 1 #異常終了。ワーカーならsupervisorが起動し直す
         finally:
-            print('終了します。')
+            log.info('終了します。')
+            if (file_name := self.profiler.stop()) is not None:
+                log.info('プロファイルを書き出しました：%s', file_name)
+            self.outbox.drain()
             self.save()
 
+    def run_async(self, stream=False):
+        '''アンテナ・LTL・通知を並行して読み込むモードで動かします。
+        stream=Trueならストリーミングで受け取ります。
+        エラーで止まったときは1を返します（mainloop()も同じ）。'''
+        from asyncengine import AsyncEngine
+        self.start_metrics()
+        self.watch_signals()
+        try:
+            AsyncEngine(self, once=_silent_mode, stream=stream).run()
+        except KeyboardInterrupt:
+            pass
+        except Exception as e:
+            log.exception('ぐえー')
+            self.mk.dm_admin("ぐえー\n"+str(e))
+            return 1 #異常終了。ワーカーならsupervisorが起動し直す
+        finally:
+            log.info('終了します。')
+            if (file_name := self.profiler.stop()) is not None:
+                log.info('プロファイルを書き出しました：%s', file_name)
+            self.outbox.drain()
+            self.save()
+
+def arg_value(name, default=None):
+    '''コマンドライン引数でnameの次に書かれた値を返します。'''
+    if name in sys.argv[:-1]:
+        return sys.argv[sys.argv.index(name)+1]
+    return default
+
 if __name__ == '__main__':
-    bot = HBDBot()
-    bot.mainloop()
\ No newline at end of file
+    data_dir = arg_value('--data-dir')
+    botlog.setup(data_path(LOG_FILE_NAME, data_dir))
+    coordinator = None
+    if (coordinator_file := arg_value('--coordinator')) is not None:
+        from coordinator import Coordinator
+        coordinator = Coordinator(coordinator_file,
+                                  worker=os.path.basename(data_dir or ''),
+                                  clock=clock.time)
+    bot = HBDBot(data_dir=data_dir, coordinator=coordinator)
+    if '--stream' in sys.argv:
+        sys.exit(bot.run_async(stream=True))
+    elif '--async' in sys.argv:
+        sys.exit(bot.run_async())
+    else:
+        sys.exit(bot.mainloop())
\ No newline at end of file
@@ -1,18 +1,22 @@
+import os
 import json
 
 class JSONSave:
 
     @staticmethod
     def save(file_name: str, **kwargs) -> None:
-        '''filenameにJSON形式で任意のデータを書き込みます。ファイルが無ければ作ります。'''
-        try:
-            f = open(file_name, 'w')
+        '''filenameにJSON形式で任意のデータを書き込みます。ファイルが無ければ作ります。
+        一時ファイルに書いてから置き換えるので、途中で落ちても元のファイルは壊れません。'''
+        if os.path.exists(file_name):
             print('ファイルを上書きします', file_name)
-        except FileNotFoundError:
-            f = open(file_name, 'x')
+        else:
             print('ファイルを作ります', file_name)
-        json.dump(kwargs, f, indent=2)
-        f.close()
+        tmp = file_name+'.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(kwargs, f, indent=2)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, file_name)
 
     @staticmethod
     def load(file_name: str) -> dict:
@@ -0,0 +1,247 @@
+import asyncio
+import logging
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+import metrics
+from metrics import stage_seconds
+
+log = logging.getLogger('hbdbot.async')
+
+class _Batch:
+    '''一回の読み込みの分。全部処理し終えたら読み込み位置を保存する。'''
+    __slots__ = ('source', 'since_id', 'remaining')
+
+    def __init__(self, source, since_id, remaining):
+        self.source = source #TimelineHandlerかNotificationHandler
+        self.since_id = since_id
+        self.remaining: int = remaining
+
+class AsyncEngine:
+    '''HBDBotのポーリングをasyncioで回す。
+
+    アンテナ・LTL・通知はそれぞれ独立した間隔（新着の多さで伸び縮みする）で
+    並行して読み込み、読み込んだものは長さの決まった待ち行列に積む。
+    処理側は待ち行列から一件ずつ取り出してcheck_note/handle_notificationに渡す。
+
+    Misskey.pyは同期のライブラリなので、読み込みはスレッドで行う。
+    HTTPセッションはbot.mkのものを共有するので接続は使い回される。
+    Botの状態（bd_listなど）に触る処理は専用の一本のスレッドで順番に行う。
+    通知は、ユーザー情報の取得と返信文の作成だけをnotification_workers本の
+    スレッドで並行して行う（同じユーザーの通知は届いた順に一件ずつ）。
+
+    stream=Trueの場合は定期的な読み込みの代わりにストリーミングで受け取り、
+    接続（再接続）のたびに切れている間の分をRESTで読み直す。'''
+
+    def __init__(self, bot, once=False, stream=False):
+        self.bot = bot
+        self.once: bool = once #各ソースを一回だけ読んで終わる（サイレントモード用）
+        self.stream: bool = stream #定期的に読み込む代わりにストリーミングで受け取る
+        self.queue = None
+        self.scheduler = None
+        self._bot_thread = ThreadPoolExecutor(max_workers=1,
+                                              thread_name_prefix='hbdbot')
+        self._workers = ThreadPoolExecutor(max_workers=bot.notification_workers,
+                                           thread_name_prefix='worker')
+        self._user_locks = {} #ユーザー -> [通知を順番に処理するためのロック, 待っている数]
+        self._in_flight = None #並行して処理中の通知の数を抑える
+        self._batches = {} #読み込み元 -> 処理中の_Batch（読み込んだ順）
+
+    def run(self):
+        try:
+            asyncio.run(self.main())
+        finally:
+            self._bot_thread.shutdown(wait=False, cancel_futures=True)
+            self._workers.shutdown(wait=False, cancel_futures=True)
+
+    async def main(self):
+        self.queue = asyncio.Queue(maxsize=self.bot.queue_size)
+        self._in_flight = asyncio.Semaphore(self.bot.queue_size)
+        metrics.registry.gauge('hbdbot_queue_depth', self.queue.qsize,
+                               'Fetched items waiting to be processed')
+        bot = self.bot
+        self.scheduler = bot.make_scheduler(lambda: bot.async_intervals)
+        pollers = {
+            'antenna': self.poll('antenna', bot.antenna,
+                      lambda: bot.antenna.get_timeline(wait=False),
+                      bot.check_note,
+                      lambda items: not bot.antenna.caught_up),
+            'ltl': self.poll('ltl', bot.ltl,
+                      lambda: bot.ltl.get_timeline(wait=False),
+                      bot.check_ltl_note,
+                      lambda items: not bot.ltl.caught_up),
+            'notification': self.poll('notification', bot.notif,
+                      lambda: bot.notif.get_notification(wait=False),
+                      self.handle_notification,
+                      lambda items: len(items) >= bot.notif.batch_size),
+        }
+        for name in list(pollers):
+            if name not in bot.sources:
+                pollers.pop(name).close() #このワーカーの担当ではない
+        pollers = list(pollers.values())
+        if self.once:
+            consumer = asyncio.create_task(self.consume())
+            await asyncio.gather(*pollers)
+            await self.queue.join()
+            await self.in_bot_thread(lambda: None) #読み込み位置の保存を待つ
+            consumer.cancel()
+            log.warning('❗❗❗サイレントモードで起動中❗❗❗')
+            return
+        if self.stream:
+            for p in pollers:
+                p.close() #ストリーミングでは使わない
+            pollers = [self.streaming()]
+        await asyncio.gather(self.housekeeping(), self.send(),
+                             self.consume(), *pollers)
+
+    async def in_bot_thread(self, func, *args):
+        '''Botの状態に触る処理を専用スレッドで実行します。'''
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._bot_thread, func, *args)
+
+    async def put(self, name, source, since_id, handler, items):
+        '''itemsを待ち行列に積みます。全部処理し終えたらsourceの読み込み位置を保存します。'''
+        if not items:
+            return
+        batch = _Batch(source, since_id, len(items))
+        self._batches.setdefault(name, deque()).append(batch)
+        for item in items:
+            await self.queue.put((handler, item, (name, batch)))
+
+    def _finish(self, entry):
+        '''一件処理し終えたときに呼びます。それより前の分も全部終わっていれば位置を保存します。'''
+        name, batch = entry
+        batch.remaining -= 1
+        batches = self._batches[name]
+        while batches and batches[0].remaining == 0:
+            b = batches.popleft()
+            self._bot_thread.submit(b.source.commit, b.since_id)
+
+    async def poll(self, name, source, fetch, handler, is_full):
+        '''fetchを新着の多さに合わせた間隔で呼び、結果を待ち行列に積みます。'''
+        while True:
+            with stage_seconds.time(stage='fetch'):
+                items = await asyncio.to_thread(fetch)
+            if items:
+                log.debug('%s：%d件を読み込み。。。', name, len(items))
+            await self.put(name, source, source.since_id, handler, items)
+            if self.once:
+                return
+            interval = self.scheduler.report(name, len(items), is_full(items),
+                                             source.calls)
+            await asyncio.sleep(interval)
+
+    async def streaming(self):
+        from streaming import StreamingIngest, streaming_url
+        bot = self.bot
+        timelines = {'antenna': (bot.antenna, bot.check_note),
+                     'ltl': (bot.ltl, bot.check_ltl_note)}
+        fetches = {
+            'antenna': (bot.antenna,
+                        lambda: bot.antenna.get_timeline(wait=False),
+                        bot.check_note),
+            'ltl': (bot.ltl,
+                    lambda: bot.ltl.get_timeline(wait=False),
+                    bot.check_ltl_note),
+            'notification': (bot.notif,
+                             lambda: bot.notif.get_notification(wait=False),
+                             self.handle_notification),
+        }
+
+        def stream_note(timeline, check):
+            def handle(note):
+                if timeline.since_id is None or note['id'] > timeline.since_id:
+                    timeline.advance(note)
+                check(note)
+            return handle
+
+        def advance_notification(n):
+            if bot.notif.since_id is None or n['id'] > bot.notif.since_id:
+                bot.notif.since_id = n['id']
+
+        async def stream_notification(n):
+            await self.in_bot_thread(advance_notification, n)
+            await self.handle_notification(n)
+
+        async def on_note(id, note):
+            timeline, check = timelines[id]
+            await self.put(id, timeline, note['id'], stream_note(timeline, check), [note])
+
+        async def on_notification(n):
+            if n['type'] in bot.notif.include_types:
+                await self.put('notification', bot.notif, n['id'],
+                               stream_notification, [n])
+
+        async def on_connect():
+            log.info('ストリーミングに接続しました。切断中の分を読み込みます。')
+            for name, (source, fetch, handler) in fetches.items():
+                items = await asyncio.to_thread(fetch)
+                await self.put(name, source, source.since_id, handler, items)
+
+        channels = {'antenna': ('antenna', {'antennaId': bot.antenna_id}),
+                    'ltl': ('localTimeline', {}),
+                    'notification': ('main', {})}
+        channels = {k: v for k, v in channels.items() if k in bot.sources}
+        fetches = {k: v for k, v in fetches.items() if k in bot.sources}
+        ingest = StreamingIngest(
+            streaming_url(bot.mk.address, bot.token, bot.mk._Misskey__scheme),
+            channels, on_note, on_notification, on_connect)
+        await ingest.run()
+
+    async def consume(self):
+        while True:
+            handler, item, entry = await self.queue.get()
+            if asyncio.iscoroutinefunction(handler):
+                #通知は待たずに次へ進む（並行して処理する）
+                await self._in_flight.acquire()
+                asyncio.create_task(self._run_task(handler, item, entry))
+                continue
+            try:
+                await self.in_bot_thread(handler, item)
+            finally:
+                self._finish(entry)
+                self.queue.task_done()
+
+    async def _run_task(self, handler, item, entry):
+        try:
+            await handler(item)
+        except Exception as e:
+            log.exception('❗❗❗通知の処理に失敗❗❗❗ %s', e)
+        finally:
+            self._finish(entry)
+            self._in_flight.release()
+            self.queue.task_done()
+
+    async def handle_notification(self, n):
+        '''通知を一件処理します。ユーザー情報の取得と返信文の作成は
+        ワーカーのスレッドで、結果の反映はBotのスレッドで行います。'''
+        bot = self.bot
+        if not await self.in_bot_thread(bot.accept_notification, n):
+            return
+        key = bot.notification_pool.key(n)
+        entry = self._user_locks.setdefault(key, [asyncio.Lock(), 0])
+        entry[1] += 1
+        try:
+            async with entry[0]:
+                loop = asyncio.get_running_loop()
+                try:
+                    prepared = await loop.run_in_executor(
+                        self._workers, bot.prepare_reply, n)
+                except Exception as e:
+                    prepared = e #apply_reply()が後でやり直す
+                await self.in_bot_thread(bot.apply_reply, n, prepared)
+        finally:
+            entry[1] -= 1
+            if not entry[1]:
+                del self._user_locks[key]
+
+    async def send(self, interval=1):
+        '''Outboxに溜まった投稿を送信できるだけ送信します。'''
+        while True:
+            await self.in_bot_thread(self.bot.outbox.drain)
+            await asyncio.sleep(interval)
+
+    async def housekeeping(self, interval=10):
+        while True:
+            await self.in_bot_thread(self.bot.housekeeping)
+            await asyncio.sleep(interval)
@@ -0,0 +1,193 @@
+'''Misskeyに繋がずにBotの処理性能を測ります。
+fakemisskey.pyの偽サーバーに合成（または記録した）ノートと通知を流し、
+時計を進めながらアンテナ・LTL・通知の読み込みと判定・送信を繰り返します。
+
+    python benchmark.py                       #合成データ
+    python benchmark.py --replay record.json  #記録したデータを再生
+    python benchmark.py --json result.json    #結果をJSONでも保存
+    python benchmark.py --baseline result.json #前の結果より悪くなっていたら終了コード1
+
+投稿・リアクション・users/showの自主レート制限は外して測ります
+（待ち時間ではなく処理そのものの速さを見るため）。'''
+import io
+import sys
+import json
+import time
+import random
+import argparse
+import tempfile
+import tracemalloc
+from contextlib import redirect_stdout
+
+import HBDBot as hbd
+from statestore import SQLiteStateStore
+from clock import SimulatedClock
+from fakemisskey import FakeMisskey
+
+REACTION = ':happy_birth_day__i@.:'
+
+def synthetic(fake, notes=2000, users=300, duration=600.0,
+              birthday_ratio=0.05, reaction_ratio=0.02, mention_ratio=0.01,
+              seed=0):
+    '''合成データを偽サーバーに登録します。
+    users人のうちbirthday_ratioの割合が今日誕生日で、
+    notes件のノートがduration秒の間にばらばらに投稿されます。'''
+    rnd = random.Random(seed)
+    today = fake.clock.today
+    names = [f'user{i:05d}' for i in range(users)]
+    for name in names:
+        if rnd.random() < birthday_ratio:
+            bd = today.replace(year=rnd.randint(1970, 2010)).isoformat() \
+                if (today.month, today.day) != (2, 29) else '2000-02-29'
+        else:
+            bd = f'{rnd.randint(1970, 2010)}-{rnd.randint(1, 12):02d}-' \
+                 f'{rnd.randint(1, 28):02d}'
+        fake.add_user(name, birthday=bd)
+    start = fake.clock.time()
+    for _ in range(notes):
+        at = start + rnd.random()*duration
+        name = rnd.choice(names)
+        r = rnd.random()
+        if r < mention_ratio:
+            fake.add_mention(name, rnd.choice(('/ping', '誕生日を登録して', '/help')), at)
+            continue
+        reactions = {REACTION: 1} if r < mention_ratio + reaction_ratio else {}
+        source = 'antenna' if rnd.random() < 0.5 else 'timeline'
+        fake.add_note(source, name, 'おはようございます', at, reactions=reactions)
+
+def make_bot(fake, data_dir) -> hbd.HBDBot:
+    '''偽サーバーに繋いだHBDBotを作ります。保存先はメモリ上のSQLiteです。'''
+    store = SQLiteStateStore(':memory:')
+    store.import_dict({'address': fake.address,
+                       'token': 'benchmark',
+                       'antenna_id': 'benchmark',
+                       'admin': 'admin',
+                       'target_reaction': REACTION,
+                       'metrics_port': 0})
+    for b in (hbd.users_show_bucket, hbd.notes_create_bucket,
+              hbd.reactions_bucket):
+        b.limits = []
+        b._tat = []
+    hbd.user_cache.clear()
+    bot = hbd.HBDBot(store=store, data_dir=data_dir)
+    #最初の読み込みで最新の一ページだけにならないよう、最初から読ませる
+    bot.antenna.since_id = bot.ltl.since_id = bot.notif.since_id = '0'
+    return bot
+
+def percentile(values, q) -> float:
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values)-1, int(q*len(values)))]
+
+def run(fake, duration=600.0, tick=5.0) -> dict:
+    '''時計をtick秒ずつduration秒ぶん進めながらBotを動かし、結果を返します。'''
+    with tempfile.TemporaryDirectory() as data_dir:
+        log = io.StringIO()
+        with redirect_stdout(log):
+            bot = make_bot(fake, data_dir)
+        fake.calls.clear()
+
+        latencies = []
+        check_note = bot.check_note
+        def timed_check_note(note):
+            started = time.perf_counter()
+            check_note(note)
+            latencies.append(time.perf_counter() - started)
+        bot.check_note = timed_check_note
+
+        tracemalloc.start()
+        started = time.perf_counter()
+        with redirect_stdout(log):
+            elapsed = 0.0
+            while elapsed < duration:
+                fake.clock.advance(tick)
+                elapsed += tick
+                bot.housekeeping()
+                bot.antenna_search(wait=False)
+                bot.ltl_search(wait=False)
+                bot.notification_check(wait=False)
+                bot.outbox.drain()
+        wall = time.perf_counter() - started
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        bot.store.close()
+
+    notes = len(latencies)
+    api = sum(fake.calls.values())
+    return {'notes': notes,
+            'wall_seconds': round(wall, 3),
+            'notes_per_second': round(notes/wall, 1) if wall else 0.0,
+            'api_calls': dict(fake.calls),
+            'api_calls_per_note': round(api/notes, 3) if notes else 0.0,
+            'decision_p50_ms': round(percentile(latencies, 0.50)*1000, 3),
+            'decision_p99_ms': round(percentile(latencies, 0.99)*1000, 3),
+            'peak_memory_kb': peak//1024,
+            'renotes': len([p for p in fake.posted if 'renoteId' in p]),
+            'replies': len([p for p in fake.posted if 'replyId' in p]),
+            'reactions': len(fake.reactions),
+            'renote_stats': dict(bot.renote_stats),
+            'user_cache': hbd.user_cache.stats()}
+
+# 悪くなったとみなす指標と向き（1なら大きいほど良い、-1なら小さいほど良い）
+CHECKS = {'notes_per_second': 1,
+          'api_calls_per_note': -1,
+          'decision_p99_ms': -1}
+
+def compare(result, baseline, slack=0.2) -> list:
+    '''resultがbaselineよりslackの割合を超えて悪くなった指標を返します。'''
+    regressions = []
+    for key, better in CHECKS.items():
+        if key not in baseline:
+            continue
+        old, new = baseline[key], result[key]
+        if better > 0:
+            worse = new < old * (1 - slack)
+        else:
+            worse = new > old * (1 + slack)
+        if worse:
+            regressions.append(f'{key}: {old} -> {new}')
+    return regressions
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--replay', help='記録したJSONファイル')
+    parser.add_argument('--notes', type=int, default=2000)
+    parser.add_argument('--users', type=int, default=300)
+    parser.add_argument('--duration', type=float, default=600.0, help='秒')
+    parser.add_argument('--tick', type=float, default=5.0, help='秒')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--latency', type=float, default=0.0,
+                        help='偽サーバーの応答にかける秒数')
+    parser.add_argument('--json', help='結果を書き出すファイル')
+    parser.add_argument('--baseline', help='比べる結果（--jsonで書き出したもの）')
+    parser.add_argument('--slack', type=float, default=0.2,
+                        help='baselineより悪くなってもよい割合')
+    args = parser.parse_args(argv)
+
+    hbd.clock = SimulatedClock()
+    fake = FakeMisskey(hbd.clock, latency=args.latency).start()
+    try:
+        if args.replay:
+            fake.load_recording(args.replay)
+        else:
+            synthetic(fake, args.notes, args.users, args.duration, seed=args.seed)
+        result = run(fake, args.duration, args.tick)
+    finally:
+        fake.stop()
+    for k, v in result.items():
+        print(f'{k}: {v}')
+    if args.json:
+        with open(args.json, 'w', encoding='utf-8') as f:
+            json.dump(result, f, ensure_ascii=False, indent=2)
+    if args.baseline:
+        with open(args.baseline, encoding='utf-8') as f:
+            regressions = compare(result, json.load(f), args.slack)
+        for r in regressions:
+            print('❗悪化：', r)
+        if regressions:
+            raise SystemExit(1)
+    return result
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,336 @@
+import os
+import pickle
+import logging
+from array import array
+from bisect import bisect_left
+from zlib import crc32
+from datetime import date, timedelta
+from functools import lru_cache
+from itertools import accumulate
+
+log = logging.getLogger('hbdbot.birthdays')
+
+try:
+    import numpy
+except ImportError:
+    numpy = None #無くても動く（一括の検索が遅くなるだけ）
+
+def is_leap_year(year:int) -> bool:
+    '''西暦年を入力すると閏年かどうか返します。'''
+    if year%400 == 0:
+        return True
+    if year%100 == 0:
+        return False
+    if year%4 == 0:
+        return True
+    return False
+
+@lru_cache(maxsize=4096)
+def parse_birthday(bd) -> date|None:
+    '''ISO形式の誕生日をdate型で返します。未設定や読めない場合はNoneです。
+    同じ文字列は一度しか読みません。'''
+    if not bd:
+        return None
+    try:
+        return date.fromisoformat(bd)
+    except ValueError:
+        return None
+
+@lru_cache(maxsize=4096)
+def datediff(bd, today: date) -> int|None:
+    '''todayと誕生日の日付の差を返します。明日なら－１、当日なら０、昨日なら１です。
+    2月29日生で平年の場合、3月1日を誕生日として扱います。
+    誕生日が設定されていない場合はNoneを返します。
+    結果は(誕生日, 今日)ごとに覚えておきます。'''
+    if (birthday := parse_birthday(bd)) is None:
+        return None
+    bmonth = birthday.month
+    bday = birthday.day
+    if bmonth == 2 and bday == 29 and not is_leap_year(today.year):
+        bmonth, bday = 3, 1
+    result = (today-date(today.year, bmonth, bday)).days
+    #今が年末で、誕生日が年始の場合
+    if result-is_leap_year(today.year) >= 363:
+        result = result-is_leap_year(today.year) - 365
+    #今が年始で、誕生日が年末の場合
+    if result+is_leap_year(today.year) <= -363:
+        result = result+is_leap_year(today.year) + 365
+    return result
+
+def day_of_year(month, day) -> int:
+    '''閏年の暦での通し日（1月1日が0、2月29日が59、12月31日が365）を返します。'''
+    return date(2000, month, day).toordinal() - _JAN1
+
+_JAN1 = date(2000, 1, 1).toordinal()
+_FEB29 = day_of_year(2, 29)
+
+class _KeyBlob:
+    '''一つのbytesに連結したキーを、番号 -> キー（bytes）の列に見せる。'''
+    __slots__ = ('blob', 'offsets')
+
+    def __init__(self, blob, offsets):
+        self.blob = blob
+        self.offsets = offsets
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, i) -> bytes:
+        return self.blob[self.offsets[i]:self.offsets[i+1]]
+
+class BirthdayStore:
+    '''フォロワーの誕生日とお祝いした時刻をまとめて持つ、省メモリな表。
+
+    ユーザーのキー（username@host）はUTF-8にしてCRC32の順に並べ、一つのbytesに連結して
+    持ちます（キーごとの文字列や辞書の項目は作らない）。並び順が番号で、番号ごとに
+    - 誕生日の通し日（day_of_year()、無ければ-1）
+    - 誕生日（date.toordinal()の値）
+    - お祝いした時刻（エポック秒、無ければ0）
+    をarrayに詰めて持ちます。誕生日の文字列やdatetimeは持ちません。
+    キーはCRC32の列をbisectで引きます。後から増えたキーは小さな辞書に足しておき、
+    ある程度溜まったら並べ直して連結し直します。
+    numpyがあれば「今日が誕生日の人」「今日お祝いした人」などの検索を一括で行います。
+
+    誕生日の部分は辞書のように使えます（bd[key] = '2000-01-01', bd.get(key) など）。
+    2月29日生まれは平年なら3月1日の誕生日として扱います。'''
+
+    SNAPSHOT_FORMAT = 2 #中身の形を変えたら上げる（古いスナップショットは読まない）
+
+    def __init__(self, bd_list=None, celeb_list=None):
+        '''bd_list: キー -> 誕生日（ISO形式）, celeb_list: キー -> お祝いした時刻（エポック秒）'''
+        self._keys = _KeyBlob(b'', array('I', [0])) #並べ替えて連結したキー
+        self._hashes = array('I') #番号 -> キーのCRC32（昇順）
+        self._new = {} #後から増えたキー -> 番号（連結し直すまで）
+        self._new_keys = [] #後から増えたキー（番号の順）
+        self._day = array('h') #誕生日の通し日
+        self._born = array('i') #誕生日のordinal
+        self._celebrated = array('q') #お祝いした時刻
+        self._odd = {} #番号 -> date型で表せない誕生日の文字列
+        self._count = 0 #誕生日のある人数
+        self._loading = True #読み込みの間は連結し直さない（最後に一度だけ）
+        for key, bd in (bd_list or {}).items():
+            self[key] = bd
+        for key, at in (celeb_list or {}).items():
+            self.celebrate(key, at)
+        self._loading = False
+        self._rebuild()
+
+    # ---- 番号の割り当て ----
+    @property
+    def _sorted(self) -> int:
+        '''連結済みのキーの数。これより後の番号は_newのキーです。'''
+        return len(self._keys)
+
+    def _find(self, key) -> int|None:
+        '''キーの番号を返します。無ければNoneです。'''
+        i = self._new.get(key)
+        if i is not None:
+            return i
+        k = key.encode()
+        h = crc32(k)
+        hashes = self._hashes
+        i = bisect_left(hashes, h)
+        while i < len(hashes) and hashes[i] == h:
+            if self._keys[i] == k:
+                return i
+            i += 1
+        return None
+
+    def _key(self, i) -> str:
+        if i < self._sorted:
+            return self._keys[i].decode()
+        return self._new_keys[i - self._sorted]
+
+    def _id(self, key) -> int:
+        '''キーの番号を返します。無ければ割り当てます。'''
+        i = self._find(key)
+        if i is not None:
+            return i
+        if not self._loading and len(self._new) >= max(4096, self._sorted // 16):
+            self._rebuild()
+        i = len(self._day)
+        self._new[key] = i
+        self._new_keys.append(key)
+        self._day.append(-1)
+        self._born.append(0)
+        self._celebrated.append(0)
+        return i
+
+    def _rebuild(self):
+        '''後から増えたキーも含めて並べ直し、連結し直します。
+        誕生日もお祝いの記録も無くなったキーはここで消えます。'''
+        rows = sorted((crc32(k := self._key(i).encode()), k, i)
+                      for i in range(len(self._day))
+                      if self._has_bd(i) or self._celebrated[i])
+        order = [i for _, _, i in rows]
+        offsets = array('I', [0])
+        offsets.extend(accumulate(len(k) for _, k, _ in rows))
+        self._keys = _KeyBlob(b''.join(k for _, k, _ in rows), offsets)
+        self._hashes = array('I', [h for h, _, _ in rows])
+        self._day = array('h', [self._day[i] for i in order])
+        self._born = array('i', [self._born[i] for i in order])
+        self._celebrated = array('q', [self._celebrated[i] for i in order])
+        if self._odd:
+            self._odd = {n: self._odd[i] for n, i in enumerate(order) if i in self._odd}
+        self._new, self._new_keys = {}, []
+
+    def _has_bd(self, i) -> bool:
+        return self._born[i] != 0 or i in self._odd
+
+    def _select(self, mask_func, values) -> list:
+        '''values（array）のうちmask_funcを満たす番号のキーを返します。'''
+        if numpy is not None:
+            hits = numpy.flatnonzero(mask_func(numpy.frombuffer(values, values.typecode)))
+        else:
+            hits = [i for i, v in enumerate(values) if mask_func(v)]
+        return [self._key(i) for i in hits]
+
+    # ---- 誕生日（辞書としての振る舞い） ----
+    def __len__(self):
+        return self._count
+
+    def __contains__(self, key):
+        i = self._find(key)
+        return i is not None and self._has_bd(i)
+
+    def __iter__(self):
+        return (self._key(i) for i in range(len(self._day)) if self._has_bd(i))
+
+    def keys(self):
+        return iter(self)
+
+    def items(self):
+        return ((k, self[k]) for k in self)
+
+    def __getitem__(self, key) -> str:
+        i = self._find(key)
+        if i is None or not self._has_bd(i):
+            raise KeyError(key)
+        if i in self._odd:
+            return self._odd[i]
+        return date.fromordinal(self._born[i]).isoformat()
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def __setitem__(self, key, bd: str):
+        i = self._id(key)
+        if not self._has_bd(i):
+            self._count += 1
+        self._odd.pop(i, None)
+        d = parse_birthday(bd)
+        if d is None or d.isoformat() != bd:
+            #読めない文字列もそのまま覚えておく（誕生日の検索には出てこない）
+            self._odd[i] = bd
+            self._day[i] = -1
+            self._born[i] = 0
+        else:
+            self._day[i] = day_of_year(d.month, d.day)
+            self._born[i] = d.toordinal()
+
+    def pop(self, key, default=None):
+        i = self._find(key)
+        if i is None or not self._has_bd(i):
+            return default
+        bd = self[key]
+        self._odd.pop(i, None)
+        self._day[i] = -1
+        self._born[i] = 0
+        self._count -= 1
+        return bd
+
+    # ---- 誕生日の検索 ----
+    @staticmethod
+    def _days_matching(day: date) -> tuple:
+        '''dayが誕生日にあたる通し日を返します。'''
+        doy = day_of_year(day.month, day.day)
+        if day.month == 3 and day.day == 1 and not is_leap_year(day.year):
+            return (doy, _FEB29)
+        return (doy,)
+
+    def on(self, day: date) -> list:
+        '''dayが誕生日にあたるユーザーのキーを返します。'''
+        return self.upcoming(day, 1)
+
+    def upcoming(self, today: date, days: int) -> list:
+        '''todayからdays日のうち（todayを含む）に誕生日が来るユーザーのキーを返します。'''
+        targets = set()
+        for n in range(days):
+            targets.update(self._days_matching(today + timedelta(days=n)))
+        #通し日 -> 対象かどうか の表を引く（最後の要素は誕生日が無い-1の分）
+        table = [False]*367
+        for doy in targets:
+            table[doy] = True
+        if numpy is not None:
+            table = numpy.array(table)
+            return self._select(lambda v: table[v], self._day)
+        return self._select(table.__getitem__, self._day)
+
+    # ---- スナップショット ----
+    def save_snapshot(self, file_name, generation):
+        '''表をそのままファイルに書き出します。
+        generation: 書き出した時点の保存先の版（StateStore.generation()）'''
+        tmp = file_name+'.tmp'
+        with open(tmp, 'wb') as f:
+            pickle.dump((BirthdayStore.SNAPSHOT_FORMAT, generation), f)
+            pickle.dump(self, f, pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp, file_name)
+
+    @staticmethod
+    def load_snapshot(file_name, generation) -> 'BirthdayStore|None':
+        '''save_snapshot()で書き出した表を読み込みます。
+        ファイルが無いか壊れている、または版がgenerationと違う（形が古い）ならNoneを返します。'''
+        try:
+            with open(file_name, 'rb') as f:
+                if pickle.load(f) != (BirthdayStore.SNAPSHOT_FORMAT, generation):
+                    return None
+                return pickle.load(f)
+        except FileNotFoundError:
+            return None
+        except Exception as e: #壊れていたら保存先から読み直すだけ
+            log.warning('❗スナップショットを読めません %s', e)
+            return None
+
+    # ---- お祝いの記録 ----
+    def celebrate(self, key, at: float):
+        '''keyのユーザーをat（エポック秒）にお祝いしたと記録します。'''
+        self._celebrated[self._id(key)] = int(at)
+
+    def celebrated_at(self, key) -> int|None:
+        '''お祝いした時刻を返します。記録が無ければNoneです。'''
+        i = self._find(key)
+        if i is None or not self._celebrated[i]:
+            return None
+        return self._celebrated[i]
+
+    def is_celebrated(self, key) -> bool:
+        return self.celebrated_at(key) is not None
+
+    def celebrated_since(self, since: float) -> list:
+        '''since（エポック秒）以降にお祝いしたユーザーのキーを返します。'''
+        since = max(int(since), 1)
+        return self._select(lambda v: v >= since, self._celebrated)
+
+    def celebrated(self) -> dict:
+        '''キー -> お祝いした時刻 の辞書を返します。'''
+        return {k: self._celebrated[self._find(k)] for k in self.celebrated_since(1)}
+
+    def uncelebrate(self, key):
+        i = self._find(key)
+        if i is None or not self._celebrated[i]:
+            return
+        self._celebrated[i] = 0
+
+    def prune_celebrated(self, before: float) -> list:
+        '''before（エポック秒）より前のお祝いの記録を消し、消したキーを返します。'''
+        before = int(before)
+        if numpy is not None:
+            keys = self._select(lambda v: (v > 0) & (v < before), self._celebrated)
+        else:
+            keys = self._select(lambda v: 0 < v < before, self._celebrated)
+        for key in keys:
+            self.uncelebrate(key)
+        return keys
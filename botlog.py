@@ -0,0 +1,99 @@
+'''Botのログ。
+loggerに書いた記録は待ち行列に入れるだけで、文字列にするのも書き出すのも別のスレッドが行います。
+- ファイル: 一件一行のJSON。max_bytesを超えたら切り替えて、古いものをbackups個残す
+- 画面: 今まで通りの一行の文章。console_levelより下は出さない
+setup()を呼ばなければどこにも書き出しません（WARNING以上だけ標準エラーに出ます）。
+
+    log = logging.getLogger('hbdbot')
+    log.debug('%s %s', lazy(summarize, note), note['id']) #DEBUGを出さない設定なら何もしない
+    log.info('リノート', extra={'note': note['id']}) #extraの値はJSONの項目になる
+
+記録は後で文字列にするので、引数に渡した辞書などをその後で書き換えないでください。'''
+import sys
+import json
+import queue
+import atexit
+import logging
+import logging.handlers
+from datetime import datetime, timezone
+
+LOGGER_NAME = 'hbdbot'
+
+# LogRecordがもともと持っている属性。これ以外はextraで渡された項目
+_RECORD_ATTRS = set(vars(logging.LogRecord('', 0, '', 0, '', (), None))) \
+    | {'message', 'asctime', 'taskName'}
+
+class lazy:
+    '''文字列が必要になったときに初めてfunc(*args)を呼ぶ。ログの引数に使います。'''
+    __slots__ = ('func', 'args')
+
+    def __init__(self, func, *args):
+        self.func = func
+        self.args = args
+
+    def __str__(self):
+        return str(self.func(*self.args))
+
+class JSONFormatter(logging.Formatter):
+    '''記録を一行のJSONにする。'''
+
+    def format(self, record) -> str:
+        entry = {'at': datetime.fromtimestamp(record.created, timezone.utc)
+                        .isoformat(timespec='milliseconds'),
+                 'level': record.levelname,
+                 'logger': record.name,
+                 'msg': record.getMessage()}
+        for k, v in vars(record).items():
+            if k not in _RECORD_ATTRS:
+                entry[k] = v
+        if record.exc_info:
+            entry['exc'] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+class _QueueHandler(logging.handlers.QueueHandler):
+    '''標準のQueueHandlerは待ち行列に入れる前に文字列にするので、それをしない。'''
+
+    def prepare(self, record):
+        return record
+
+_listener = None
+_console = None
+_file = None
+
+def setup(file_name, level='INFO', console_level='INFO',
+          max_bytes=10*1024*1024, backups=5):
+    '''ログの書き出しを始めます。プログラムの終わりに残りを書き出してから止めます。'''
+    global _listener, _console, _file
+    if _listener is not None:
+        return
+    _file = logging.handlers.RotatingFileHandler(
+        file_name, maxBytes=max_bytes, backupCount=backups, encoding='utf-8')
+    _file.setFormatter(JSONFormatter())
+    _console = logging.StreamHandler(sys.stdout)
+    _console.setFormatter(logging.Formatter('%(message)s'))
+    q = queue.SimpleQueue()
+    _listener = logging.handlers.QueueListener(q, _file, _console,
+                                               respect_handler_level=True)
+    logger = logging.getLogger(LOGGER_NAME)
+    logger.handlers = [_QueueHandler(q)]
+    logger.propagate = False
+    set_levels(level, console_level)
+    _listener.start()
+    atexit.register(stop)
+
+def set_levels(level='INFO', console_level='INFO'):
+    '''ファイルと画面に書き出す最低のレベルを変えます。動いている間に呼べます。'''
+    level, console_level = level.upper(), console_level.upper()
+    if _file is not None:
+        _file.setLevel(level)
+        _console.setLevel(console_level)
+    #どちらにも出さないレベルの記録は作らずに捨てる
+    logging.getLogger(LOGGER_NAME).setLevel(
+        min(logging.getLevelName(level), logging.getLevelName(console_level)))
+
+def stop():
+    '''待ち行列に残っている記録を書き出してから止めます。'''
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
@@ -0,0 +1,63 @@
+import time
+from datetime import date, datetime, timedelta, timezone
+
+JST = timezone(timedelta(hours=9), "JST")
+
+class Clock:
+    '''Botが使う時計。
+    今日の日付はtick()を呼んだときに一度だけ求めて、次のtick()まで使い回します。
+    日時はtzの時刻をタイムゾーン情報なしのdatetimeで返します。'''
+
+    def __init__(self, tz=JST):
+        self.tz = tz
+        self.today: date = None
+        self.today_start: float = 0.0 #今日の0時のtime()の値
+        self.tick()
+
+    def time(self) -> float:
+        return time.time()
+
+    def sleep(self, seconds):
+        time.sleep(seconds)
+
+    def at(self, timestamp) -> datetime:
+        '''time()の値をtzの日時にします。'''
+        return datetime.fromtimestamp(timestamp, self.tz).replace(tzinfo=None)
+
+    def now(self) -> datetime:
+        return self.at(self.time())
+
+    def timestamp(self, dt) -> float:
+        '''tzの日時（文字列かdatetime型。タイムゾーン情報なし）をtime()の値にします。'''
+        if type(dt) is str:
+            dt = datetime.fromisoformat(dt)
+        if dt.tzinfo is None:
+            dt = dt.replace(tzinfo=self.tz)
+        return dt.timestamp()
+
+    def tick(self) -> date:
+        '''今日の日付を求め直します。ループ一回ごとに呼びます。'''
+        self.today = self.now().date()
+        self.today_start = self.timestamp(datetime.combine(self.today, datetime.min.time()))
+        return self.today
+
+    def date_of(self, iso) -> date:
+        '''APIが返した日時（createdAtなど）がtzで何日にあたるかを返します。'''
+        return datetime.fromisoformat(iso).astimezone(self.tz).date()
+
+class SimulatedClock(Clock):
+    '''自分で進める時計。sleep()は待たずに時計を進めます。
+    日付の変わり目などをテストで早送りするのに使います。'''
+
+    def __init__(self, start=None, tz=JST):
+        self.t: float = time.time() if start is None else start
+        super().__init__(tz)
+
+    def time(self) -> float:
+        return self.t
+
+    def advance(self, seconds):
+        self.t += seconds
+
+    def sleep(self, seconds):
+        self.advance(seconds)
@@ -0,0 +1,116 @@
+import time
+import sqlite3
+import threading
+
+from ratelimit import Bucket
+
+class Coordinator:
+    '''複数のワーカー（HBDBotのプロセス）で共有するSQLiteファイル。
+    - お祝い（リノート、0時のお祝い）は一人一日一回。先に取ったワーカーだけが行う
+    - 処理済みのID。アンテナが重なっていても、同じノートや通知は一度だけ処理する
+    - 投稿の枠。ワーカー全体で自主レート制限を守る（SharedBucket）
+    書き込みはどれも一回のSQLで済む（枠の消費だけは一つのトランザクション）ので、
+    プロセスをまたいでも取り合いになりません。'''
+
+    SCHEMA = (
+        'CREATE TABLE IF NOT EXISTS claims('
+        ' key TEXT, day TEXT, worker TEXT, at REAL, PRIMARY KEY(key, day))',
+        'CREATE INDEX IF NOT EXISTS claims_at ON claims(at)',
+        'CREATE TABLE IF NOT EXISTS seen('
+        ' id TEXT PRIMARY KEY, worker TEXT, at REAL)',
+        'CREATE INDEX IF NOT EXISTS seen_at ON seen(at)',
+        'CREATE TABLE IF NOT EXISTS budget('
+        ' name TEXT, idx INTEGER, tat REAL, PRIMARY KEY(name, idx))',
+    )
+
+    def __init__(self, file_name, worker='', clock=time.time):
+        self.file_name = file_name
+        self.worker = worker #このワーカーの名前（記録用）
+        self.clock = clock
+        self.db = sqlite3.connect(file_name, check_same_thread=False,
+                                  isolation_level=None, timeout=30)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('PRAGMA synchronous=NORMAL')
+        for sql in self.SCHEMA:
+            self.db.execute(sql)
+        self._lock = threading.Lock() #このプロセスの中でのトランザクションの取り合い
+
+    def claim(self, key, day) -> bool:
+        '''day（日付の文字列）のkeyを自分のものにします。
+        他のワーカーが先に取っていたらFalseを返します。'''
+        with self._lock:
+            cur = self.db.execute(
+                'INSERT OR IGNORE INTO claims VALUES (?, ?, ?, ?)',
+                (key, day, self.worker, self.clock()))
+        return cur.rowcount == 1
+
+    def claim_seen(self, id) -> bool:
+        '''IDを処理済みにします。どのワーカーもまだ処理していなければTrueを返します。
+        自分が取ったIDならTrueを返します（処理し終える前に落ちて、読み直したとき）。'''
+        with self._lock:
+            cur = self.db.execute(
+                'INSERT OR IGNORE INTO seen VALUES (?, ?, ?)',
+                (id, self.worker, self.clock()))
+            if cur.rowcount == 1:
+                return True
+            row = self.db.execute('SELECT worker FROM seen WHERE id = ?',
+                                  (id,)).fetchone()
+        return row is not None and row[0] == self.worker
+
+    def bucket(self, name, limits) -> 'SharedBucket':
+        return SharedBucket(self, name, limits)
+
+    def prune(self, before):
+        '''before（time()の値）より古い記録を消します。'''
+        with self._lock:
+            self.db.execute('DELETE FROM claims WHERE at < ?', (before,))
+            self.db.execute('DELETE FROM seen WHERE at < ?', (before,))
+
+    def stats(self, day) -> dict:
+        '''dayにワーカーごとに取ったお祝いの数を返します。'''
+        with self._lock:
+            return dict(self.db.execute(
+                'SELECT worker, COUNT(*) FROM claims WHERE day = ? GROUP BY worker',
+                (day,)))
+
+    def close(self):
+        self.db.close()
+
+class SharedBucket(Bucket):
+    '''ワーカー全体で共有するBucket。枠の状態はCoordinatorのファイルに置きます。'''
+
+    def __init__(self, coordinator, name, limits):
+        super().__init__(name, limits, clock=coordinator.clock)
+        self.coordinator = coordinator
+
+    def _load(self):
+        rows = dict(self.coordinator.db.execute(
+            'SELECT idx, tat FROM budget WHERE name = ?', (self.name,)))
+        self._tat = [rows.get(i, 0.0) for i in range(len(self.limits))]
+
+    def time_until_available(self) -> float:
+        with self.coordinator._lock:
+            self._load()
+        return super().time_until_available()
+
+    def try_acquire(self) -> bool:
+        c = self.coordinator
+        with c._lock:
+            c.db.execute('BEGIN IMMEDIATE') #読んでから書くまで他のプロセスを待たせる
+            try:
+                self._load()
+                if super().time_until_available() > 0:
+                    self.denied += 1
+                    c.db.execute('COMMIT')
+                    return False
+                now = self.clock()
+                self._tat = [max(tat, now) + period/count
+                             for (count, period), tat in zip(self.limits, self._tat)]
+                c.db.executemany(
+                    'INSERT OR REPLACE INTO budget VALUES (?, ?, ?)',
+                    [(self.name, i, tat) for i, tat in enumerate(self._tat)])
+            except BaseException:
+                c.db.execute('ROLLBACK')
+                raise
+            c.db.execute('COMMIT')
+        return True
@@ -0,0 +1,200 @@
+'''オフラインでBotを動かすための、Misskey APIの代役。
+ベンチマーク（benchmark.py）から使います。'''
+import json
+import time
+import threading
+from collections import Counter
+from datetime import datetime, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from clock import SimulatedClock
+
+def make_id(at, seq) -> str:
+    '''時刻順に並ぶID（Misskeyのaidと同じく文字列の大小で時刻順になる）'''
+    return f'{int(at*1000):012x}{seq:06x}'
+
+def isoformat(at) -> str:
+    return datetime.fromtimestamp(at, timezone.utc).isoformat(
+        timespec='milliseconds').replace('+00:00', 'Z')
+
+class FakeMisskey:
+    '''localhostで動くMisskey APIの代役。
+    ノートや通知は時刻つきで登録しておき、clockがその時刻を過ぎたものだけを返します。
+    エンドポイントごとの呼び出し回数をcallsに数えます。'''
+
+    def __init__(self, clock=None, host='127.0.0.1', port=0, latency=0.0):
+        self.clock = clock or SimulatedClock()
+        self.latency: float = latency #一回の呼び出しにかける秒数（実時間）
+        self.host = host
+        self.port = port
+        self.server = None
+        self._lock = threading.Lock()
+        self._seq = 0
+        self.timelines = {'antenna': [], 'timeline': []} #[(時刻, ノート)]
+        self.notifications = [] #[(時刻, 通知)]
+        self.users = {} #username -> ユーザー情報
+        self.followers = [] #[{'id', 'follower'}]
+        self.posted = []
+        self.reactions = []
+        self.calls = Counter()
+
+    @property
+    def address(self) -> str:
+        return f'http://{self.host}:{self.port}'
+
+    def next_id(self, at) -> str:
+        with self._lock:
+            self._seq += 1
+            return make_id(at, self._seq)
+
+    # ---- データの登録 ----
+    def add_user(self, username, birthday=None, name=None, follower=True):
+        user = {'id': 'u'+username, 'username': username,
+                'name': name or username, 'host': None,
+                'birthday': birthday, 'instance': None}
+        self.users[username] = user
+        if follower:
+            self.followers.append({'id': self.next_id(self.clock.time()),
+                                   'follower': user})
+        return user
+
+    def _user_lite(self, username):
+        u = self.users.get(username) or self.add_user(username, follower=False)
+        return {k: u[k] for k in ('id', 'username', 'name', 'host')}
+
+    def add_note(self, source, username, text, at=None, reactions=None,
+                 cw=None, files=None):
+        '''sourceはantennaかtimeline。atはclockの時刻（省略時は今）'''
+        at = self.clock.time() if at is None else at
+        note = {'id': self.next_id(at),
+                'createdAt': isoformat(at),
+                'text': text,
+                'cw': cw,
+                'files': files or [],
+                'reactions': reactions or {},
+                'user': self._user_lite(username)}
+        self.timelines[source].append((at, note))
+        return note
+
+    def add_mention(self, username, text, at=None):
+        at = self.clock.time() if at is None else at
+        note = self.add_note('timeline', username, '@HBDBot '+text, at)
+        n = {'id': self.next_id(at), 'createdAt': note['createdAt'],
+             'type': 'mention', 'user': note['user'], 'note': note}
+        self.notifications.append((at, n))
+        return n
+
+    def add_follow(self, username, at=None):
+        at = self.clock.time() if at is None else at
+        n = {'id': self.next_id(at), 'createdAt': isoformat(at),
+             'type': 'follow', 'user': self._user_lite(username)}
+        self.notifications.append((at, n))
+        return n
+
+    def load_recording(self, file_name, start=None):
+        '''記録したJSONを読み込みます。
+        形式: {"antenna": [ノート], "timeline": [ノート],
+               "notifications": [通知], "users": [ユーザー情報]}
+        一番古いcreatedAtがstart（省略時はclockの今）になるように時刻をずらします。'''
+        with open(file_name, encoding='utf-8') as f:
+            rec = json.load(f)
+        for u in rec.get('users', []):
+            self.users[u['username']] = u
+        def stamp(item):
+            return datetime.fromisoformat(item['createdAt']).timestamp()
+        items = [x for k in ('antenna', 'timeline', 'notifications')
+                 for x in rec.get(k, [])]
+        if not items:
+            return
+        shift = (self.clock.time() if start is None else start) - \
+            min(stamp(x) for x in items)
+        for source in ('antenna', 'timeline'):
+            for note in rec.get(source, []):
+                at = stamp(note) + shift
+                note['createdAt'] = isoformat(at)
+                self.timelines[source].append((at, note))
+        for n in rec.get('notifications', []):
+            at = stamp(n) + shift
+            n['createdAt'] = isoformat(at)
+            self.notifications.append((at, n))
+
+    # ---- API ----
+    def _visible(self, items) -> list:
+        now = self.clock.time()
+        return sorted((x for at, x in items if at <= now), key=lambda x: x['id'])
+
+    @staticmethod
+    def _page(items, since_id=None, until_id=None, limit=10) -> list:
+        if since_id is not None:
+            return [x for x in items if x['id'] > since_id][:limit]
+        if until_id is not None:
+            items = [x for x in items if x['id'] < until_id]
+        return items[::-1][:limit]
+
+    def api(self, endpoint, p) -> object:
+        self.calls[endpoint] += 1
+        if endpoint in ('meta', 'i'):
+            return {'id': 'bot', 'username': 'HBDBot', 'name': 'HBDBot'}
+        if endpoint == 'antennas/notes':
+            return self._page(self._visible(self.timelines['antenna']),
+                              p.get('sinceId'), p.get('untilId'), p.get('limit', 10))
+        if endpoint == 'notes/timeline':
+            return self._page(self._visible(self.timelines['timeline']),
+                              p.get('sinceId'), p.get('untilId'), p.get('limit', 10))
+        if endpoint == 'i/notifications':
+            items = self._visible(self.notifications)
+            types = p.get('includeTypes')
+            if types:
+                items = [n for n in items if n['type'] in types]
+            return self._page(items, p.get('sinceId'), p.get('untilId'),
+                              p.get('limit', 10))
+        if endpoint == 'users/show':
+            user = self.users.get(p.get('username'))
+            if user is None:
+                raise KeyError('NO_SUCH_USER')
+            return user
+        if endpoint == 'users/followers':
+            items = sorted(self.followers, key=lambda x: x['id'])
+            return self._page(items, p.get('sinceId'), p.get('untilId'),
+                              p.get('limit', 10))
+        if endpoint == 'notes/create':
+            self.posted.append(p)
+            return {'createdNote': {'id': self.next_id(self.clock.time())}}
+        if endpoint == 'notes/reactions/create':
+            self.reactions.append(p)
+            return None
+        raise KeyError('NO_SUCH_ENDPOINT')
+
+    def start(self):
+        fake = self
+        class Handler(BaseHTTPRequestHandler):
+            def do_POST(self):
+                endpoint = self.path.split('/api/', 1)[-1]
+                length = int(self.headers.get('Content-Length', 0))
+                params = json.loads(self.rfile.read(length) or b'{}')
+                if fake.latency:
+                    time.sleep(fake.latency)
+                try:
+                    result = fake.api(endpoint, params)
+                except KeyError as e:
+                    status, result = 400, {'error': {'code': e.args[0],
+                                                     'message': e.args[0]}}
+                else:
+                    status = 200 if result is not None else 204
+                self.send_response(status)
+                body = b'' if status == 204 else json.dumps(result).encode()
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+            def log_message(self, *args):
+                pass
+        self.server = ThreadingHTTPServer((self.host, self.port), Handler)
+        self.port = self.server.server_address[1]
+        threading.Thread(target=self.server.serve_forever, daemon=True,
+                         name='fakemisskey').start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
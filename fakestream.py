@@ -0,0 +1,126 @@
+'''オフラインでストリーミングを試すための、Misskeyのストリーミングの代役。
+python fakestream.py でStreamingIngestとつないで動作を確認できます。'''
+import json
+import asyncio
+from datetime import datetime, timezone
+
+from streaming import websockets, StreamingIngest
+
+class FakeStreamingServer:
+    '''localhostで動くストリーミングサーバー。
+    connectメッセージでチャンネルを購読したクライアントに、
+    publish_note/publish_notificationで好きなノートや通知を流せます。'''
+
+    def __init__(self, host='127.0.0.1', port=0):
+        self.host = host
+        self.port = port
+        self.server = None
+        self.clients = {} #websocket -> {チャンネルのID: チャンネル名}
+        self.subscribed = asyncio.Condition()
+
+    @property
+    def url(self) -> str:
+        return f'ws://{self.host}:{self.port}/streaming?i=fake'
+
+    async def start(self):
+        self.server = await websockets.serve(self._handler, self.host, self.port)
+        self.port = self.server.sockets[0].getsockname()[1]
+        return self
+
+    async def stop(self):
+        self.server.close()
+        await self.server.wait_closed()
+
+    async def _handler(self, ws):
+        self.clients[ws] = {}
+        try:
+            async for raw in ws:
+                message = json.loads(raw)
+                body = message.get('body', {})
+                if message.get('type') == 'connect':
+                    self.clients[ws][body['id']] = body['channel']
+                    async with self.subscribed:
+                        self.subscribed.notify_all()
+                elif message.get('type') == 'disconnect':
+                    self.clients[ws].pop(body['id'], None)
+        except websockets.exceptions.ConnectionClosed:
+            pass
+        finally:
+            del self.clients[ws]
+
+    async def wait_subscribed(self, channel, timeout=5.0):
+        '''どれかのクライアントがchannelを購読するまで待ちます。'''
+        def subscribed():
+            return any(channel in subs.values() for subs in self.clients.values())
+        async with self.subscribed:
+            await asyncio.wait_for(self.subscribed.wait_for(subscribed), timeout)
+
+    async def publish(self, channel, type, body) -> int:
+        '''channelを購読しているクライアントに流します。送った数を返します。'''
+        sent = 0
+        for ws, subs in list(self.clients.items()):
+            for id, ch in subs.items():
+                if ch != channel:
+                    continue
+                await ws.send(json.dumps({
+                    'type': 'channel',
+                    'body': {'id': id, 'type': type, 'body': body}}))
+                sent += 1
+        return sent
+
+    async def publish_note(self, channel, note) -> int:
+        return await self.publish(channel, 'note', note)
+
+    async def publish_notification(self, notification) -> int:
+        return await self.publish('main', 'notification', notification)
+
+    async def drop_connections(self):
+        '''接続中のクライアントを全部切断します（再接続の確認用）。'''
+        dropped = list(self.clients)
+        for ws in dropped:
+            await ws.close()
+        while any(ws in self.clients for ws in dropped):
+            await asyncio.sleep(0.01)
+
+def make_note(id, text, username='fake', host=None, reactions=None):
+    '''それらしい形のノートを作ります。'''
+    return {'id': id,
+            'createdAt': datetime.now(timezone.utc).isoformat(),
+            'text': text,
+            'cw': None,
+            'files': [],
+            'reactions': reactions or {},
+            'user': {'id': 'u'+username, 'username': username,
+                     'name': username, 'host': host}}
+
+async def demo():
+    server = await FakeStreamingServer().start()
+    received = []
+    async def on_note(id, note):
+        received.append(note['id'])
+        print('受信：', id, note['id'], note['text'])
+    async def on_notification(n):
+        print('通知：', n['type'])
+    async def on_connect():
+        print('接続しました')
+    ingest = StreamingIngest(server.url,
+                             {'ltl': ('localTimeline', {})},
+                             on_note, on_notification, on_connect,
+                             reconnect_min=0.1)
+    stop = asyncio.Event()
+    task = asyncio.create_task(ingest.run(stop))
+    await server.wait_subscribed('localTimeline')
+    await server.publish_note('localTimeline', make_note('a1', '今日誕生日！'))
+    await asyncio.sleep(0.1)
+    await server.drop_connections()
+    await server.wait_subscribed('localTimeline')
+    await server.publish_note('localTimeline', make_note('a2', 'おめでとう'))
+    await asyncio.sleep(0.1)
+    stop.set()
+    await server.drop_connections()
+    await task
+    await server.stop()
+    print('受信したノート：', received, '再接続：', ingest.reconnects)
+
+if __name__ == '__main__':
+    asyncio.run(demo())
@@ -0,0 +1,117 @@
+import time
+import logging
+
+log = logging.getLogger('hbdbot.followersync')
+
+class FollowerSync:
+    '''フォロワー一覧を大きめのページで少しずつ読み、誕生日リストとの差分を反映する。
+
+    フォロワー一覧にはプロフィール（誕生日）も含まれるので、
+    users_showを一人ずつ呼ぶ代わりにページ数ぶんの呼び出しで済みます。
+    - 誕生日が追加・変更されたフォロワーはupdate(key, bd)
+    - 誕生日を消したフォロワーと、前の周回ではフォロワーだったのに
+      一周読んでも見つからなかった（フォロー解除した）ユーザーはremove(key)
+    フォローせずに「登録して」で登録したユーザーや、周回の途中でフォローして
+    registered(key)で知らされたユーザーは消しません。
+    読み込み位置は on_cursor(until_id) で保存し、再起動したらそこから続けます。
+    途中から再開した周回では、見つからなかったユーザーの削除は行いません。'''
+
+    def __init__(self,
+                 mk,
+                 known, #今登録されているユーザー（inで調べられるもの）を返す関数。コピーしない
+                 update,
+                 remove,
+                 batch_size = 100,
+                 page_interval = 10.0, #sec ページの間隔
+                 pass_interval = 6*3600.0, #sec 一周読み終えてから次の周回までの間隔
+                 on_cursor = None,
+                 clock = time.monotonic
+                 ):
+        self.mk = mk
+        self.known = known
+        self.update = update
+        self.remove = remove
+        self.batch_size: int = batch_size
+        self.page_interval: float = page_interval
+        self.pass_interval: float = pass_interval
+        self.on_cursor = on_cursor
+        self.clock = clock
+        self.user_id = None
+        self.cursor = None #until_id
+        self.full_pass = True #この周回を最初から読んでいるか
+        self.seen = set() #この周回で一覧に見つけたユーザー
+        self.notified = set() #この周回の間にregistered()で知らされたユーザー
+        self.followers = set() #前の周回で見つけたフォロワー（フォロー解除の証拠に使う）
+        self.pass_known = set() #この周回を始めたときに登録されていたユーザー
+        self.next_due = clock()
+        self.stats = {'pages': 0, 'added': 0, 'updated': 0, 'removed': 0}
+
+    def resume(self, cursor):
+        '''保存しておいた読み込み位置から再開します。'''
+        self.cursor = cursor
+        self.full_pass = cursor is None
+
+    def registered(self, key):
+        '''通知（フォロー、登録して）で登録したユーザーを知らせます。
+        一覧を読み終えたページより後でフォローした人も、この周回では消しません。'''
+        self.notified.add(key)
+
+    def due(self) -> bool:
+        return self.clock() >= self.next_due
+
+    def step(self) -> int:
+        '''フォロワー一覧を一ページ読んで反映します。読んだ人数を返します。'''
+        if self.user_id is None:
+            self.user_id = self.mk.i()['id']
+        if self.cursor is None:
+            self.pass_known = set(self.known()) #全員をコピーするのは周回の初めだけ
+        page = self.mk.users_followers(user_id=self.user_id,
+                                       until_id=self.cursor,
+                                       limit=self.batch_size)
+        self.stats['pages'] += 1
+        known = self.known()
+        for following in page:
+            follower = following.get('follower')
+            if follower is None:
+                continue
+            host = follower['host']
+            key = follower['username'] if host is None \
+                else follower['username']+'@'+host
+            self.seen.add(key)
+            if 'birthday' not in follower:
+                continue #プロフィールが含まれていない
+            bd = follower['birthday']
+            if bd:
+                was_known = key in known
+                if self.update(key, bd):
+                    self.stats['updated' if was_known else 'added'] += 1
+            elif key in known:
+                self.remove(key)
+                self.stats['removed'] += 1
+        if len(page) < self.batch_size:
+            self.finish_pass(known)
+        else:
+            self.cursor = page[-1]['id']
+            self.next_due = self.clock() + self.page_interval
+        if self.on_cursor is not None:
+            self.on_cursor(self.cursor)
+        return len(page)
+
+    def finish_pass(self, known):
+        if self.full_pass:
+            #前の周回ではフォロワーで、周回の初めから登録されていて、今回見つからなかった人だけ消す
+            gone = [key for key in (self.followers & self.pass_known)
+                                   - self.seen - self.notified
+                    if key in known]
+            for key in gone:
+                self.remove(key)
+                self.stats['removed'] += 1
+            self.followers = self.seen
+        else:
+            self.followers |= self.seen
+        log.info('フォロワー同期：%s', self.stats)
+        self.cursor = None
+        self.full_pass = True
+        self.seen = set()
+        self.notified = set()
+        self.next_due = self.clock() + self.pass_interval
@@ -0,0 +1,143 @@
+import time
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from misskey import Misskey
+
+class HostUnavailable(Exception):
+    '''サーバーが応答しないので、しばらく問い合わせを止めている'''
+
+class _TimeoutSession(requests.Session):
+    '''timeoutが指定されていないリクエストにも既定のtimeoutをつけるセッション'''
+
+    def __init__(self, timeout):
+        super().__init__()
+        self.default_timeout = timeout
+
+    def request(self, *args, **kwargs):
+        if kwargs.get('timeout') is None:
+            kwargs['timeout'] = self.default_timeout
+        return super().request(*args, **kwargs)
+
+class CircuitBreaker:
+    '''続けてthreshold回失敗したら、cool_down秒のあいだ問い合わせを止める。
+    cool_downが過ぎたら一回だけ試し、成功すれば元に戻す。'''
+
+    def __init__(self, threshold=3, cool_down=300.0, clock=time.monotonic):
+        self.threshold: int = threshold
+        self.cool_down: float = cool_down #sec
+        self.clock = clock
+        self.failures = 0
+        self.opened_at = None
+
+    @property
+    def is_open(self) -> bool:
+        return self.opened_at is not None and \
+            self.clock() - self.opened_at < self.cool_down
+
+    def allow(self) -> bool:
+        return not self.is_open
+
+    def success(self):
+        self.failures = 0
+        self.opened_at = None
+
+    def failure(self):
+        self.failures += 1
+        if self.failures >= self.threshold:
+            self.opened_at = self.clock()
+
+class HostRegistry:
+    '''サーバーごとのMisskeyクライアントを使い回す。
+    - HTTPセッション（接続）はサーバーごとに一つだけ作って使い回す
+    - timeoutと再試行の回数に上限を設ける
+    - 失敗が続く他のサーバーへの問い合わせはしばらく止める（CircuitBreaker）。
+      homeは止めずに通信の例外をそのまま返し、呼び出し側で後からやり直す
+    - Misskey以外のソフトウェアのサーバーは覚えておいて問い合わせない'''
+
+    def __init__(self,
+                 home = 'misskey.io', #host=Noneのときのサーバー
+                 timeout = 10.0, #sec
+                 retries = 2,
+                 threshold = 3,
+                 cool_down = 300.0, #sec
+                 unsupported_ttl = 24*3600.0, #sec
+                 clock = time.monotonic
+                 ):
+        self.home = home
+        self.timeout: float = timeout
+        self.retries: int = retries
+        self.threshold: int = threshold
+        self.cool_down: float = cool_down
+        self.unsupported_ttl: float = unsupported_ttl
+        self.clock = clock
+        self._clients = {}
+        self._breakers = {}
+        self._unsupported = {} #host -> 記録した時刻
+
+    def session(self) -> requests.Session:
+        session = _TimeoutSession(self.timeout)
+        retry = Retry(total=self.retries,
+                      backoff_factor=0.5,
+                      status_forcelist=(502, 503, 504),
+                      allowed_methods=None) #APIはPOSTなのでPOSTも再試行する
+        adapter = HTTPAdapter(max_retries=retry, pool_maxsize=4)
+        session.mount('https://', adapter)
+        session.mount('http://', adapter)
+        return session
+
+    def breaker(self, host) -> CircuitBreaker:
+        host = host or self.home
+        if host not in self._breakers:
+            self._breakers.setdefault(host, CircuitBreaker(
+                self.threshold, self.cool_down, self.clock))
+        return self._breakers[host]
+
+    def client(self, host=None) -> Misskey:
+        '''hostのクライアントを返します。初めてのhostなら作ります。'''
+        host = host or self.home
+        client = self._clients.get(host)
+        if client is None:
+            client = Misskey(host, session=self.session())
+            client.timeout = self.timeout
+            #別のスレッドが先に作っていたらそちらを使う
+            client = self._clients.setdefault(host, client)
+        return client
+
+    def call(self, host, func):
+        '''func(client)を呼びます。他のサーバーとの通信に失敗したらHostUnavailableを、
+        homeとの通信に失敗したらrequestsの例外をそのまま投げます。'''
+        if host is None or host == self.home:
+            return func(self.client(host))
+        breaker = self.breaker(host)
+        if not breaker.allow():
+            raise HostUnavailable(host or self.home)
+        try:
+            result = func(self.client(host))
+        except requests.RequestException as e:
+            breaker.failure()
+            raise HostUnavailable(host or self.home) from e
+        breaker.success()
+        return result
+
+    def users_show(self, username, host=None) -> dict:
+        return self.call(host, lambda mk: mk.users_show(username=username))
+
+    def mark_unsupported(self, host):
+        '''Misskey以外のソフトウェアのサーバーとして覚えます。'''
+        self._unsupported[host] = self.clock()
+
+    def is_unsupported(self, host) -> bool:
+        at = self._unsupported.get(host)
+        if at is None:
+            return False
+        if self.clock() - at > self.unsupported_ttl:
+            self._unsupported.pop(host, None) #他のスレッドが先に消していてもよい
+            return False
+        return True
+
+    def stats(self) -> dict:
+        return {'clients': len(self._clients),
+                'open_circuits': sorted(h for h, b in self._breakers.items()
+                                        if b.is_open),
+                'unsupported_hosts': len(self._unsupported)}
@@ -0,0 +1,217 @@
+import time
+import bisect
+import logging
+import functools
+import threading
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+log = logging.getLogger('hbdbot.metrics')
+
+class _Metric:
+    type = ''
+
+    def __init__(self, name, help=''):
+        self.name = name
+        self.help = help
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _key(labels) -> tuple:
+        return tuple(sorted(labels.items()))
+
+    @staticmethod
+    def _fmt_labels(key, extra=()) -> str:
+        pairs = list(key) + list(extra)
+        if not pairs:
+            return ''
+        return '{'+','.join(f'{k}="{v}"' for k, v in pairs)+'}'
+
+    def render(self) -> list:
+        return [f'# HELP {self.name} {self.help}',
+                f'# TYPE {self.name} {self.type}']
+
+class Counter(_Metric):
+    '''増えるだけの数'''
+    type = 'counter'
+
+    def __init__(self, name, help=''):
+        super().__init__(name, help)
+        self.values = {}
+
+    def inc(self, value=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self.values[key] = self.values.get(key, 0) + value
+
+    def total(self) -> float:
+        return sum(self.values.values())
+
+    def render(self) -> list:
+        lines = super().render()
+        for key, v in sorted(self.values.items()):
+            lines.append(f'{self.name}{self._fmt_labels(key)} {v}')
+        return lines
+
+class Gauge(_Metric):
+    '''読み出すたびにfuncを呼んで値を得る数（待ち行列の長さなど）。
+    funcは数値か、ラベルの辞書 -> 数値 の辞書を返します。'''
+    type = 'gauge'
+
+    def __init__(self, name, func, help=''):
+        super().__init__(name, help)
+        self.func = func
+
+    def collect(self) -> dict:
+        try:
+            value = self.func()
+        except Exception:
+            return {}
+        if isinstance(value, dict):
+            return {self._key(k if isinstance(k, dict) else {'name': k}): v
+                    for k, v in value.items()}
+        return {(): value}
+
+    def render(self) -> list:
+        lines = super().render()
+        for key, v in sorted(self.collect().items()):
+            lines.append(f'{self.name}{self._fmt_labels(key)} {v}')
+        return lines
+
+class Histogram(_Metric):
+    '''所要時間などの分布'''
+    type = 'histogram'
+    BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+    def __init__(self, name, help='', buckets=BUCKETS):
+        super().__init__(name, help)
+        self.buckets = tuple(buckets)
+        self.values = {} #labels -> [各バケツの数..., 合計, 件数]
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        i = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            v = self.values.setdefault(key, [0]*(len(self.buckets)+3))
+            v[i] += 1
+            v[-2] += value
+            v[-1] += 1
+
+    @contextmanager
+    def time(self, **labels):
+        '''with文の中の所要時間を記録します。'''
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, **labels)
+
+    def quantile(self, q, **labels) -> float:
+        '''バケツの境界から分位点のおおよその値を返します。'''
+        v = self.values.get(self._key(labels))
+        if not v or not v[-1]:
+            return 0.0
+        rank = q * v[-1]
+        seen = 0
+        for bound, n in zip(self.buckets + (float('inf'),), v):
+            seen += n
+            if seen >= rank:
+                return bound
+        return float('inf')
+
+    def render(self) -> list:
+        lines = super().render()
+        for key, v in sorted(self.values.items()):
+            cumulative = 0
+            for bound, n in zip(self.buckets, v):
+                cumulative += n
+                lines.append(f'{self.name}_bucket'
+                             f'{self._fmt_labels(key, [("le", bound)])} {cumulative}')
+            lines.append(f'{self.name}_bucket'
+                         f'{self._fmt_labels(key, [("le", "+Inf")])} {v[-1]}')
+            lines.append(f'{self.name}_sum{self._fmt_labels(key)} {v[-2]}')
+            lines.append(f'{self.name}_count{self._fmt_labels(key)} {v[-1]}')
+        return lines
+
+class Registry:
+    def __init__(self):
+        self.metrics = {}
+
+    def counter(self, name, help='') -> Counter:
+        return self.metrics.setdefault(name, Counter(name, help))
+
+    def histogram(self, name, help='', **kwargs) -> Histogram:
+        return self.metrics.setdefault(name, Histogram(name, help, **kwargs))
+
+    def gauge(self, name, func, help='') -> Gauge:
+        '''同じ名前で登録し直すとfuncを置き換えます。'''
+        self.metrics[name] = Gauge(name, func, help)
+        return self.metrics[name]
+
+    def render(self) -> str:
+        '''Prometheusのテキスト形式で返します。'''
+        lines = []
+        for m in self.metrics.values():
+            lines += m.render()
+        return '\n'.join(lines)+'\n'
+
+    def summary(self) -> dict:
+        '''ログ用に一行に収まる要約を返します。'''
+        result = {}
+        for m in self.metrics.values():
+            if isinstance(m, Counter):
+                result[m.name] = m.total()
+            elif isinstance(m, Histogram):
+                for key, v in m.values.items():
+                    label = ','.join(str(x[1]) for x in key)
+                    result[f'{m.name}[{label}]'] = \
+                        f'n={v[-1]} avg={v[-2]/v[-1]*1000:.1f}ms' if v[-1] else 'n=0'
+        return result
+
+    def serve(self, port, host='127.0.0.1') -> ThreadingHTTPServer:
+        '''http://host:port/metrics で公開します。'''
+        registry = self
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split('?')[0] != '/metrics':
+                    self.send_error(404)
+                    return
+                body = registry.render().encode()
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+            def log_message(self, *args):
+                pass
+        server = ThreadingHTTPServer((host, port), Handler)
+        threading.Thread(target=server.serve_forever, daemon=True,
+                         name='metrics').start()
+        log.info('メトリクス：http://%s:%d/metrics', host, server.server_address[1])
+        return server
+
+registry = Registry()
+
+api_calls = registry.counter(
+    'hbdbot_api_calls_total', 'Misskey API calls by endpoint and result')
+api_seconds = registry.histogram(
+    'hbdbot_api_seconds', 'Misskey API latency by endpoint')
+stage_seconds = registry.histogram(
+    'hbdbot_stage_seconds', 'Pipeline stage latency (fetch, resolve, decide, post)')
+function_seconds = registry.histogram(
+    'hbdbot_function_seconds', 'Wall time of selected functions',
+    buckets=(0.0001, 0.0005)+Histogram.BUCKETS)
+
+def timed(name):
+    '''関数の所要時間をfunction_secondsに記録するデコレーター。'''
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            started = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                function_seconds.observe(time.perf_counter() - started,
+                                         function=name)
+        return wrapper
+    return decorator
@@ -0,0 +1,186 @@
+import os
+import json
+import time
+import random
+import logging
+from collections import deque, Counter
+from requests import RequestException
+from misskey import exceptions
+
+from metrics import stage_seconds
+
+log = logging.getLogger('hbdbot.outbox')
+
+class Outbox:
+    '''投稿やリアクションの送信待ち行列。
+
+    put()で積んだものはファイルに一行ずつ追記して記録し、drain()で送信します。
+    送信はレートリミットの枠が空いているものだけを行い、待つことはしません。
+    失敗したものは指数的に間隔を空けて（ゆらぎ付き）再送します。
+    同じ (kind, target) は二度積みません。
+    not_beforeで送信時刻を指定でき、priorityが小さいものから先に送信します。
+    強制終了しても、次に起動したときに未送信のものから再開します。'''
+
+    def __init__(self,
+                 file_name,
+                 client,
+                 buckets = None, #method名 -> ratelimit.Bucket
+                 base_delay = 30.0, #sec
+                 max_delay = 1800.0, #sec
+                 max_attempts = 10,
+                 clock = time.time
+                 ):
+        self.file_name = file_name
+        self.client = client
+        self.buckets = buckets or {}
+        self.base_delay: float = base_delay
+        self.max_delay: float = max_delay
+        self.max_attempts: int = max_attempts
+        self.clock = clock
+        self.pending = {} #(kind, target) -> entry。挿入順＝送信順
+        self.done = deque(maxlen=1000) #送信済みの(kind, target)。重複防止用
+        self._done_set = set()
+        self.sent = 0
+        self.sent_by_kind = Counter()
+        self.dropped_by_kind = Counter()
+        self.failed = 0
+        self.dropped = 0
+        self.paused = False #Trueなら積むだけで送信しない（サイレントモード用）
+        self.replay()
+
+    def __len__(self):
+        return len(self.pending)
+
+    def put(self, kind, target, method, not_before=0, priority=0,
+            **kwargs) -> bool:
+        '''送信を予約します。同じものが既にあればFalseを返します。
+        kind: 種類（renote, reply, reaction, greeting...）
+        target: 重複判定に使うID（ノートIDなど）
+        method: clientのメソッド名, kwargs: その引数
+        not_before: この時刻（time.time()の値）までは送信しない
+        priority: 小さいほど先に送信する'''
+        key = (kind, target)
+        if key in self.pending or key in self._done_set:
+            return False
+        kwargs = {k: getattr(v, 'value', v) for k, v in kwargs.items()} #Enum -> str
+        entry = {'op': 'put', 'kind': kind, 'target': target,
+                 'method': method, 'kwargs': kwargs,
+                 'attempts': 0, 'next_at': not_before,
+                 'priority': priority}
+        self.pending[key] = entry
+        self._append(entry)
+        return True
+
+    def drain(self, max_items=None) -> int:
+        '''送信できるものを送信し、送信できた件数を返します。'''
+        if self.paused:
+            return 0
+        now = self.clock()
+        count = 0
+        limited = set()
+        queue = sorted(self.pending.items(),
+                       key=lambda item: item[1].get('priority', 0))
+        for key, entry in queue:
+            if max_items is not None and count >= max_items:
+                break
+            if entry['next_at'] > now or entry['method'] in limited:
+                continue
+            bucket = self.buckets.get(entry['method'])
+            if bucket is not None and not bucket.try_acquire():
+                limited.add(entry['method'])
+                continue
+            try:
+                with stage_seconds.time(stage='post'):
+                    getattr(self.client, entry['method'])(**entry['kwargs'])
+            except (RequestException, exceptions.MisskeyAPIException) as e:
+                self._retry(key, entry, e)
+                continue
+            self._finish(key, 'done')
+            self.sent += 1
+            self.sent_by_kind[entry['kind']] += 1
+            count += 1
+        return count
+
+    def _retry(self, key, entry, error):
+        entry['attempts'] += 1
+        if getattr(error, 'code', None) == 'TIMELINE_HAYASUGI_YABAI':
+            log.warning('タイムライン速すぎヤバイエラー❗')
+        log.warning('❗❗❗送信に失敗❗❗❗ %s %s %s', entry['kind'], entry['target'], error)
+        self.failed += 1
+        if entry['attempts'] >= self.max_attempts:
+            log.warning('❗❗❗送信に立て続けに失敗❗❗❗ %s %s', entry['kind'], entry['target'])
+            self._finish(key, 'drop')
+            self.dropped += 1
+            self.dropped_by_kind[entry['kind']] += 1
+            return
+        delay = min(self.max_delay, self.base_delay * 2**(entry['attempts']-1))
+        entry['next_at'] = self.clock() + delay * random.uniform(0.5, 1.5)
+        self._append({'op': 'retry', 'kind': entry['kind'],
+                      'target': entry['target'],
+                      'attempts': entry['attempts'],
+                      'next_at': entry['next_at']})
+
+    def _finish(self, key, op):
+        del self.pending[key]
+        self._mark_done(key)
+        self._append({'op': op, 'kind': key[0], 'target': key[1]})
+
+    def _mark_done(self, key):
+        if len(self.done) == self.done.maxlen:
+            self._done_set.discard(self.done[0])
+        self.done.append(key)
+        self._done_set.add(key)
+
+    def _append(self, record):
+        with open(self.file_name, 'a', encoding='utf-8') as f:
+            f.write(json.dumps(record, ensure_ascii=False)+'\n')
+            f.flush()
+            os.fsync(f.fileno())
+
+    def replay(self):
+        '''ファイルの記録から未送信のものを復元します。'''
+        try:
+            f = open(self.file_name, 'r', encoding='utf-8')
+        except FileNotFoundError:
+            return
+        with f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError:
+                    continue #書き込み途中で落ちた行
+                key = (record['kind'], record['target'])
+                if record['op'] == 'put':
+                    self.pending[key] = record
+                elif record['op'] == 'retry' and key in self.pending:
+                    self.pending[key]['attempts'] = record['attempts']
+                    self.pending[key]['next_at'] = record['next_at']
+                elif record['op'] in ('done', 'drop'):
+                    self.pending.pop(key, None)
+                    self._mark_done(key)
+        if self.pending:
+            log.info('未送信の投稿を復元しました：%d', len(self.pending))
+        self.compact()
+
+    def compact(self):
+        '''記録ファイルを未送信のものと最近送信したものだけに書き直します。'''
+        tmp = self.file_name+'.tmp'
+        with open(tmp, 'w', encoding='utf-8') as f:
+            for kind, target in self.done:
+                f.write(json.dumps({'op': 'done', 'kind': kind, 'target': target},
+                                   ensure_ascii=False)+'\n')
+            for entry in self.pending.values():
+                f.write(json.dumps(entry, ensure_ascii=False)+'\n')
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, self.file_name)
+
+    def count_pending(self, kind) -> int:
+        return sum(1 for k, _ in self.pending if k == kind)
+
+    def stats(self) -> dict:
+        return {'pending': len(self.pending),
+                'sent': self.sent,
+                'sent_by_kind': dict(self.sent_by_kind),
+                'failed': self.failed,
+                'dropped': self.dropped}
@@ -0,0 +1,108 @@
+import os
+import sys
+import time
+import cProfile
+import threading
+from collections import Counter
+
+class Sampler:
+    '''interval秒ごとに全スレッドのスタックを覗いて数える。
+    プロファイル中もBotの処理はほとんど遅くなりません。'''
+
+    def __init__(self, interval=0.005):
+        self.interval: float = interval
+        self.stacks = Counter() #折り畳んだスタック -> 見かけた回数
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, daemon=True,
+                                        name='profiler')
+        self._thread.start()
+
+    def _run(self):
+        me = threading.get_ident()
+        names = {}
+        while not self._stop.wait(self.interval):
+            for ident, frame in sys._current_frames().items():
+                if ident == me:
+                    continue
+                if ident not in names:
+                    names = {t.ident: t.name for t in threading.enumerate()}
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append(f'{code.co_name} '
+                                 f'({os.path.basename(code.co_filename)}:{code.co_firstlineno})')
+                    frame = frame.f_back
+                stack.append(names.get(ident, str(ident)))
+                self.stacks[';'.join(reversed(stack))] += 1
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+
+    def write(self, file_name):
+        '''flamegraph.plやspeedscopeで読める形（折り畳んだスタック）で書き出します。'''
+        with open(file_name, 'w', encoding='utf-8') as f:
+            for stack, count in self.stacks.most_common():
+                f.write(f'{stack} {count}\n')
+
+class Profiler:
+    '''動いているBotを、指定した回数のループの間だけプロファイルする。
+    - mode='sample': Sampler。全スレッドの折り畳んだスタック（.folded）を書き出す
+    - mode='cprofile': cProfile。start()を呼んだスレッドだけを測り、pstats（.prof）を書き出す
+    start()とcycle()はBotのループと同じスレッドから呼びます。'''
+
+    MODES = ('sample', 'cprofile')
+
+    def __init__(self, file_prefix, clock=time.time):
+        self.file_prefix = file_prefix #書き出すファイル名の頭（時刻と拡張子を足す）
+        self.clock = clock
+        self.mode = None #プロファイル中ならそのモード
+        self.remaining = 0 #残りのループの回数
+        self._profiler = None
+
+    @property
+    def active(self) -> bool:
+        return self.mode is not None
+
+    def start(self, cycles, mode='sample') -> bool:
+        '''cycles回のループの間プロファイルします。すでにプロファイル中ならFalseを返します。'''
+        if self.active or mode not in self.MODES:
+            return False
+        if mode == 'cprofile':
+            self._profiler = cProfile.Profile()
+            self._profiler.enable()
+        else:
+            self._profiler = Sampler()
+            self._profiler.start()
+        self.mode = mode
+        self.remaining = max(1, cycles)
+        return True
+
+    def cycle(self) -> str|None:
+        '''ループ一回ごとに呼びます。回数に達したら止めて、書き出したファイル名を返します。'''
+        if not self.active:
+            return None
+        self.remaining -= 1
+        if self.remaining > 0:
+            return None
+        return self.stop()
+
+    def stop(self) -> str|None:
+        '''プロファイルを止めて書き出します。書き出したファイル名を返します。'''
+        if not self.active:
+            return None
+        stamp = time.strftime('%Y%m%d-%H%M%S', time.localtime(self.clock()))
+        if self.mode == 'cprofile':
+            self._profiler.disable()
+            file_name = f'{self.file_prefix}-{stamp}.prof'
+            self._profiler.dump_stats(file_name)
+        else:
+            self._profiler.stop()
+            file_name = f'{self.file_prefix}-{stamp}.folded'
+            self._profiler.write(file_name)
+        self.mode = None
+        self._profiler = None
+        return file_name
@@ -1,47 +1,109 @@
 import time
-from datetime import datetime, timedelta
+import asyncio
+import logging
+import threading
 
-post_log = []
-def rate_limit(limit_ph=60, limit_pm=10, post_rate=1):
+log = logging.getLogger('hbdbot.ratelimit')
+
+class Bucket:
+    '''名前付きのレートリミット（GCRA方式のトークンバケツ）。
+    (回数, 秒) の制限を複数持てて、すべてを満たしたときだけ通します。
+    記録するのは制限ごとの「次に空く理論上の時刻」だけなので、
+    判定は投稿の履歴の長さによらず一定の時間で済みます。
+    複数のスレッドで共有して使えます。'''
+
+    def __init__(self, name, limits, clock=time.monotonic, sleep=time.sleep):
+        self.name = name
+        self.limits = [(count, period) for count, period in limits if count]
+        self.clock = clock
+        self.sleep = sleep #wait()で待つ関数
+        self._tat = [0.0]*len(self.limits) #theoretical arrival time
+        self._lock = threading.Lock()
+        self.denied = 0 #枠が無くて通さなかった回数
+        self.waited = 0.0 #wait()で待った秒数の合計
+
+    def time_until_available(self) -> float:
+        '''次に通せるようになるまでの秒数を返します。今すぐ通せるなら0です。'''
+        now = self.clock()
+        wait = 0.0
+        for (count, period), tat in zip(self.limits, self._tat):
+            wait = max(wait, max(tat, now) + period/count - period - now)
+        return wait
+
+    def sustained_rate(self) -> float:
+        '''長く続けたときに通せる回数（回/秒）を返します。'''
+        return min((count/period for count, period in self.limits),
+                   default=float('inf'))
+
+    def try_acquire(self) -> bool:
+        '''今すぐ通せるなら枠を一つ消費してTrue、通せないならFalseを返します。'''
+        with self._lock:
+            if self.time_until_available() > 0:
+                self.denied += 1
+                return False
+            now = self.clock()
+            self._tat = [max(tat, now) + period/count
+                         for (count, period), tat in zip(self.limits, self._tat)]
+            return True
+
+    def wait(self):
+        '''通せるようになるまで待ってから枠を消費します。'''
+        while not self.try_acquire():
+            td = self.time_until_available()
+            log.info('____レート制限中（%s）____ 解除まで%.0f秒', self.name, td)
+            self.sleep(td)
+            self.waited += td
+
+    async def acquire(self):
+        '''通せるようになるまで他の処理を止めずに待ってから枠を消費します。'''
+        while not self.try_acquire():
+            td = self.time_until_available()
+            await asyncio.sleep(td)
+            self.waited += td
+
+buckets = {}
+_clock = time.monotonic
+_sleep = time.sleep
+
+def use_clock(clock, sleep=time.sleep):
+    '''get_bucket()で作るBucketの時計を差し替えます。作り済みのものも差し替えます。
+    SimulatedClockを渡すと、待たずに枠が空くところまで早送りできます。'''
+    global _clock, _sleep
+    _clock, _sleep = clock, sleep
+    for b in buckets.values():
+        if b.clock != clock:
+            b._tat = [0.0]*len(b.limits) #時計が変わると前の時刻は比べられない
+        b.clock, b.sleep = clock, sleep
+
+def get_bucket(name, limit_ph=None, limit_pm=None, post_rate=None) -> Bucket:
+    '''名前に対応するBucketを返します。無ければ指定の制限で作ります。
+    limit_ph: 一時間あたりの回数, limit_pm: 一分あたりの回数,
+    post_rate: 連続で通すときの最低間隔（秒）'''
+    if name not in buckets:
+        limits = [(limit_ph, 3600), (limit_pm, 60)]
+        if post_rate:
+            limits.append((1, post_rate))
+        buckets[name] = Bucket(name, limits, clock=_clock, sleep=_sleep)
+    return buckets[name]
+
+def rate_limit(limit_ph=60, limit_pm=10, post_rate=1, bucket='default'):
     '''APIの送信に自主的なレートリミットを設けます。
-    デコレートされた関数は区別なくカウントされます。
-    レート制限中は処理を完全に止めます。'''
-    global post_log
+    同じbucket名でデコレートされた関数は同じ枠でカウントされます。
+    レート制限中は枠が空くまで待ちます。'''
     def _rate_limit(func):
+        b = get_bucket(bucket, limit_ph, limit_pm, post_rate)
         def rate_limit_wrapper(*args, **kwargs):
-            while last_hour() >= limit_ph:
-                print('____レート制限中（時）____')
-                print('解除はだいたい', post_log[0]+timedelta(hours=1))
-                td = post_log[0]+timedelta(hours=1) - datetime.now()
-                time.sleep(td.seconds+60)
-            while last_minute() >= limit_pm:
-                print('____レート制限中（分）____')
-                print('解除はだいたい', post_log[0]+timedelta(minutes=2))
-                td = post_log[-limit_pm]+timedelta(minutes=2) - datetime.now()
-                time.sleep(td.seconds+60)
-            func(*args, **kwargs)
-            post_log.append(datetime.now())
-            time.sleep(post_rate)
+            b.wait()
+            return func(*args, **kwargs)
+        rate_limit_wrapper.bucket = b
         return rate_limit_wrapper
     return _rate_limit
 
-def last_hour():
-    global post_log
-    post_log = [t for t in post_log \
-                if t+timedelta(hours=1) > datetime.now()]
-    return len(post_log)
-
-def last_minute():
-    global post_log
-    minut = [t for t in post_log \
-             if t+timedelta(minutes=1) > datetime.now()]
-    return len(minut)
-
 class TestMethods:
-    @rate_limit(limit_ph=10, limit_pm=5)
+    @rate_limit(limit_ph=10, limit_pm=5, bucket='note')
     def note(self, text):
         print('N:',text)
-    @rate_limit(limit_ph=10, limit_pm=5)
+    @rate_limit(limit_ph=10, limit_pm=5, bucket='react')
     def react(self):
         print('reaction')
 
@@ -52,6 +114,4 @@ if __name__ == '__main__':
             tm.react()
         else:
             tm.note(msg)
-        print([t.strftime('%H:%M') for t in post_log])
-
-
+        print({n: round(b.time_until_available(), 1) for n, b in buckets.items()})
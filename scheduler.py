@@ -0,0 +1,131 @@
+import time
+
+class AdaptiveInterval:
+    '''読み込み元一つ分の読み込み間隔。
+    最近の到着ペース（件/秒）を指数移動平均で覚えておき、
+    一回の読み込みでtarget_fill×batch_size件くらいが取れる間隔に合わせます。
+    - 空振りが続いたらbackoff倍ずつ間隔を延ばす
+    - 満杯（batch_size件以上、または追いついていない）ならすぐ最短間隔にする
+    間隔は常に min_interval 以上 max_interval 以下です。'''
+
+    def __init__(self,
+                 name,
+                 min_interval,
+                 max_interval,
+                 batch_size,
+                 initial = None,
+                 backoff = 1.5,
+                 target_fill = 0.5,
+                 alpha = 0.3,
+                 clock = time.monotonic
+                 ):
+        self.name = name
+        self.min_interval: float = min_interval
+        self.max_interval: float = max_interval
+        self.batch_size: int = batch_size
+        self.backoff: float = backoff
+        self.target_fill: float = target_fill
+        self.alpha: float = alpha
+        self.clock = clock
+        self.interval: float = self._clamp(initial or min_interval)
+        self.rate = 0.0 #件/秒
+        self.last_polled = None
+        self.next_due = clock()
+
+    def _clamp(self, interval) -> float:
+        return min(self.max_interval, max(self.min_interval, interval))
+
+    def report(self, count, full=False) -> float:
+        '''読み込んだ件数を報告します。次の読み込みまでの間隔を返します。'''
+        now = self.clock()
+        if self.last_polled is not None:
+            sample = count / max(now - self.last_polled, 1e-3)
+            if self.rate == 0:
+                self.rate = sample
+            else:
+                self.rate += self.alpha * (sample - self.rate)
+        self.last_polled = now
+        if full or count >= self.batch_size:
+            interval = self.min_interval
+        elif count == 0:
+            interval = self.interval * self.backoff
+        elif self.rate > 0:
+            interval = self.target_fill * self.batch_size / self.rate
+        else:
+            interval = self.interval
+        self.interval = self._clamp(interval)
+        self.next_due = now + self.interval
+        return self.interval
+
+class PollScheduler:
+    '''複数の読み込み元の間隔をまとめて管理する。
+    budget_pm（一分あたりのAPI呼び出し数の上限）を指定すると、
+    全部の読み込み元を最短間隔で回しても上限を超えないように最短間隔を引き上げます。
+    一回の読み込みで何ページもめくったときは、その分だけ次の読み込みを遅らせます。'''
+
+    def __init__(self, budget_pm=None, clock=time.monotonic):
+        self.budget_pm = budget_pm
+        self.clock = clock
+        self.sources = {}
+
+    def add(self, name, min_interval, max_interval, batch_size, **kwargs):
+        self.sources[name] = AdaptiveInterval(
+            name, min_interval, max_interval, batch_size,
+            clock=self.clock, **kwargs)
+        self._apply_budget()
+        return self.sources[name]
+
+    def update(self, name, **kwargs):
+        '''読み込み元の設定（min_interval, max_interval, batch_size, interval）を変えます。
+        それまでの到着ペースはそのまま引き継ぎます。'''
+        s = self.sources[name]
+        for k, v in kwargs.items():
+            setattr(s, k, v)
+        self._apply_budget()
+        s.interval = s._clamp(s.interval)
+        s.next_due = min(s.next_due, self.clock() + s.interval)
+
+    def _apply_budget(self):
+        if not self.budget_pm:
+            return
+        floor = self._call_interval()
+        for s in self.sources.values():
+            s.min_interval = max(s.min_interval, floor)
+            s.max_interval = max(s.max_interval, s.min_interval)
+            s.interval = s._clamp(s.interval)
+
+    def _call_interval(self) -> float:
+        '''予算内に収まる、読み込み元一つあたりのAPI呼び出しの間隔（秒）を返します。'''
+        return 60 * len(self.sources) / self.budget_pm
+
+    def report(self, name, count, full=False, calls=1) -> float:
+        '''読み込んだ件数と、そのためにAPIを呼んだ回数を報告します。
+        次の読み込みまでの間隔を返します。'''
+        s = self.sources[name]
+        interval = s.report(count, full)
+        if self.budget_pm and calls > 1:
+            #呼んだ回数の分の予算を使い切るまで次を待たせる（max_intervalより長くなることもある）
+            interval = max(interval, calls * self._call_interval())
+            s.next_due = s.last_polled + interval
+        return interval
+
+    def due(self) -> list:
+        '''読み込む時刻になった読み込み元の名前を返します。'''
+        now = self.clock()
+        return [name for name, s in self.sources.items() if s.next_due <= now]
+
+    def time_until_next(self) -> float:
+        '''次にどれかの読み込み元を読むまでの秒数を返します。'''
+        now = self.clock()
+        return max(0.0, min(s.next_due for s in self.sources.values()) - now)
+
+    def intervals(self) -> dict:
+        return {name: round(s.interval, 1) for name, s in self.sources.items()}
+
+def spread(count, start, window, min_gap=0.0) -> list:
+    '''count件の送信時刻をstartからwindow秒の間に均等に割り振ります。
+    間隔がmin_gap秒より短くなる場合はmin_gap秒ずつ空け、windowからはみ出します。'''
+    if count <= 0:
+        return []
+    gap = max(window / count, min_gap)
+    return [start + gap*i for i in range(count)]
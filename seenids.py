@@ -0,0 +1,54 @@
+import time
+from collections import OrderedDict
+
+class SeenIds:
+    '''処理済みのID（通知・ノート）の集合。
+    追加した順に覚えておき、capacity件を超えるかmax_age秒より古くなったら
+    古いものから忘れます。判定は辞書を引くだけなので件数によらず一定です。
+    IDをそのまま覚えるので誤判定（偽陽性）はありません。'''
+
+    def __init__(self, capacity=10000, max_age=2*24*3600, clock=time.time):
+        self.capacity: int = capacity
+        self.max_age: float = max_age #sec
+        self.clock = clock
+        self._ids = OrderedDict() #id -> 追加した時刻
+        self.duplicates = 0 #既に処理済みだったので弾いた回数
+
+    def __len__(self):
+        return len(self._ids)
+
+    def __contains__(self, id):
+        return id in self._ids
+
+    def __iter__(self):
+        return iter(self._ids.items())
+
+    def add(self, id, at=None) -> bool:
+        '''IDを記録します。初めてのIDならTrue、処理済みならFalseを返します。'''
+        if id in self._ids:
+            self.duplicates += 1
+            return False
+        self._ids[id] = self.clock() if at is None else at
+        while len(self._ids) > self.capacity:
+            self._ids.popitem(last=False)
+        return True
+
+    def prune(self) -> float:
+        '''max_ageより古いものを忘れます。忘れる基準の時刻を返します。'''
+        limit = self.clock() - self.max_age
+        while self._ids:
+            id, at = next(iter(self._ids.items()))
+            if at >= limit:
+                break
+            self._ids.popitem(last=False)
+        return limit
+
+    @property
+    def false_positive_rate(self) -> float:
+        return 0.0
+
+    def stats(self) -> dict:
+        return {'size': len(self._ids),
+                'capacity': self.capacity,
+                'duplicates': self.duplicates,
+                'false_positive_rate': self.false_positive_rate}
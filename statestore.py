@@ -0,0 +1,253 @@
+import json
+import time
+import uuid
+import logging
+import sqlite3
+
+from JSONSave import JSONSave
+
+log = logging.getLogger('hbdbot.statestore')
+
+class StateStore:
+    '''Botの状態の保存先。
+    誕生日・お祝い済み・処理済みID・読み込み位置は変わったその時に少しずつ書き込み、
+    設定値はsave()のときにまとめて書き込みます。'''
+
+    def load(self, lists=True) -> dict:
+        '''保存されている状態を辞書で返します。
+        設定値のほか、bd_list, celeb_list, seen, cursors を含みます。
+        seenは処理済みの (ID, 時刻) を古い順に並べたリストです。
+        lists=Falseならbd_listとceleb_listを読みません（スナップショットから読むとき）。'''
+        raise NotImplementedError
+
+    def generation(self) -> str|None:
+        '''誕生日とお祝いの記録の版を返します。どちらかが変わるたびに変わります。
+        版を数えない保存先はNoneを返します（スナップショットを使わない）。'''
+        return None
+
+    def set_value(self, key, value):
+        '''設定値を一つ書き込みます。'''
+        raise NotImplementedError
+
+    def set_birthday(self, user, bd):
+        raise NotImplementedError
+
+    def delete_birthday(self, user):
+        raise NotImplementedError
+
+    def set_celebrated(self, user, at):
+        raise NotImplementedError
+
+    def delete_celebrated(self, user):
+        raise NotImplementedError
+
+    def add_seen(self, id, at):
+        '''処理済みのIDを書き込みます。'''
+        raise NotImplementedError
+
+    def prune_seen(self, before):
+        '''時刻beforeより前に処理したIDを消します。'''
+        raise NotImplementedError
+
+    def set_cursor(self, name, since_id):
+        '''タイムラインや通知をどこまで読んだかを書き込みます。'''
+        raise NotImplementedError
+
+    def flush(self):
+        '''書き込みを確定させます。'''
+
+    def close(self):
+        self.flush()
+
+    def import_dict(self, dic):
+        '''load()と同じ形の辞書をまとめて書き込みます。'''
+        for k, v in dic.items():
+            if k == 'bd_list':
+                for user, bd in v.items():
+                    self.set_birthday(user, bd)
+            elif k == 'celeb_list':
+                for user, at in v.items():
+                    self.set_celebrated(user, at)
+            elif k == 'seen':
+                for id, at in v:
+                    self.add_seen(id, at)
+            elif k == 'responded':
+                #以前の形式。返信済みの通知IDのリスト
+                now = time.time()
+                for id in v:
+                    self.add_seen('n:'+id, now)
+            elif k == 'cursors':
+                for name, since_id in v.items():
+                    self.set_cursor(name, since_id)
+            else:
+                self.set_value(k, v)
+        self.flush()
+
+class JSONStateStore(StateStore):
+    '''今まで通りJSONファイル一つに保存する。
+    変更はメモリ上で受け付け、flush()でファイル全体を書き直します。'''
+
+    def __init__(self, file_name):
+        self.file_name = file_name
+        self.data = {'bd_list': {}, 'celeb_list': {},
+                     'seen': [], 'cursors': {}}
+        loaded = JSONSave.load(file_name=file_name)
+        if loaded is not None:
+            self.data.update(loaded)
+        self.dirty = False
+
+    def load(self, lists=True) -> dict:
+        return {k: (v.copy() if isinstance(v, (dict, list)) else v)
+                for k, v in self.data.items()
+                if lists or k not in ('bd_list', 'celeb_list')}
+
+    def _set(self, table, key, value):
+        self.data[table][key] = value
+        self.dirty = True
+
+    def _delete(self, table, key):
+        self.data[table].pop(key, None)
+        self.dirty = True
+
+    def set_value(self, key, value):
+        self.data[key] = value
+        self.dirty = True
+
+    def set_birthday(self, user, bd):
+        self._set('bd_list', user, bd)
+
+    def delete_birthday(self, user):
+        self._delete('bd_list', user)
+
+    def set_celebrated(self, user, at):
+        self._set('celeb_list', user, at)
+
+    def delete_celebrated(self, user):
+        self._delete('celeb_list', user)
+
+    def add_seen(self, id, at):
+        self.data['seen'].append([id, at])
+        self.dirty = True
+
+    def prune_seen(self, before):
+        self.data['seen'] = [s for s in self.data['seen'] if s[1] >= before]
+        self.dirty = True
+
+    def set_cursor(self, name, since_id):
+        self._set('cursors', name, since_id)
+
+    def flush(self):
+        if self.dirty:
+            JSONSave.save(file_name=self.file_name, **self.data)
+            self.dirty = False
+
+class SQLiteStateStore(StateStore):
+    '''SQLite（WALモード）に保存する。変更は一件ずつupsertするので、
+    書き込みの量はフォロワー数ではなく変更の数に比例します。'''
+
+    SCHEMA = (
+        'CREATE TABLE IF NOT EXISTS config('
+        ' key TEXT PRIMARY KEY, value TEXT)',
+        'CREATE TABLE IF NOT EXISTS birthdays('
+        ' user TEXT PRIMARY KEY, bd TEXT)',
+        'CREATE TABLE IF NOT EXISTS celebrated('
+        ' user TEXT PRIMARY KEY, at TEXT)',
+        'CREATE TABLE IF NOT EXISTS seen('
+        ' id TEXT PRIMARY KEY, at REAL)',
+        'CREATE INDEX IF NOT EXISTS seen_at ON seen(at)',
+        'CREATE TABLE IF NOT EXISTS cursors('
+        ' name TEXT PRIMARY KEY, since_id TEXT)',
+        'CREATE TABLE IF NOT EXISTS generation(id TEXT, n INTEGER)',
+    ) + tuple( #誕生日とお祝いの記録が変わるたびに版を進める
+        f'CREATE TRIGGER IF NOT EXISTS {table}_{op.lower()} AFTER {op} ON {table}'
+        ' BEGIN UPDATE generation SET n = n + 1; END'
+        for table in ('birthdays', 'celebrated')
+        for op in ('INSERT', 'UPDATE', 'DELETE'))
+
+    def __init__(self, file_name):
+        self.file_name = file_name
+        #asyncモードではBot専用スレッドから使うのでスレッドの確認はしない
+        self.db = sqlite3.connect(file_name, check_same_thread=False,
+                                  isolation_level=None)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('PRAGMA synchronous=NORMAL')
+        for sql in self.SCHEMA:
+            self.db.execute(sql)
+        if self.db.execute('SELECT 1 FROM generation').fetchone() is None:
+            #ファイルごとに違うIDを振り、別のファイルのスナップショットと取り違えない
+            self.db.execute('INSERT INTO generation VALUES (?, 0)',
+                            (uuid.uuid4().hex,))
+
+    def is_empty(self) -> bool:
+        return self.db.execute('SELECT 1 FROM config LIMIT 1').fetchone() is None
+
+    def load(self, lists=True) -> dict:
+        result = {k: json.loads(v) for k, v in
+                  self.db.execute('SELECT key, value FROM config')}
+        if lists:
+            result['bd_list'] = dict(self.db.execute(
+                'SELECT user, bd FROM birthdays'))
+            result['celeb_list'] = dict(self.db.execute(
+                'SELECT user, at FROM celebrated'))
+        result['seen'] = self.db.execute(
+            'SELECT id, at FROM seen ORDER BY at').fetchall()
+        result['cursors'] = dict(self.db.execute(
+            'SELECT name, since_id FROM cursors'))
+        return result
+
+    def generation(self) -> str:
+        id, n = self.db.execute('SELECT id, n FROM generation').fetchone()
+        return f'{id}:{n}'
+
+    def set_value(self, key, value):
+        self.db.execute('INSERT OR REPLACE INTO config VALUES (?, ?)',
+                        (key, json.dumps(value, ensure_ascii=False)))
+
+    def set_birthday(self, user, bd):
+        self.db.execute('INSERT OR REPLACE INTO birthdays VALUES (?, ?)',
+                        (user, bd))
+
+    def delete_birthday(self, user):
+        self.db.execute('DELETE FROM birthdays WHERE user = ?', (user,))
+
+    def set_celebrated(self, user, at):
+        self.db.execute('INSERT OR REPLACE INTO celebrated VALUES (?, ?)',
+                        (user, at))
+
+    def delete_celebrated(self, user):
+        self.db.execute('DELETE FROM celebrated WHERE user = ?', (user,))
+
+    def add_seen(self, id, at):
+        self.db.execute('INSERT OR IGNORE INTO seen VALUES (?, ?)', (id, at))
+
+    def prune_seen(self, before):
+        self.db.execute('DELETE FROM seen WHERE at < ?', (before,))
+
+    def set_cursor(self, name, since_id):
+        self.db.execute('INSERT OR REPLACE INTO cursors VALUES (?, ?)',
+                        (name, since_id))
+
+    def import_dict(self, dic):
+        self.db.execute('BEGIN')
+        try:
+            super().import_dict(dic)
+        except BaseException:
+            self.db.execute('ROLLBACK')
+            raise
+        self.db.execute('COMMIT')
+
+    def close(self):
+        self.db.close()
+
+def migrate_json(json_file_name, store: StateStore) -> bool:
+    '''今までのJSONファイルの中身をstoreに移します。移せたかどうかを返します。'''
+    dic = JSONSave.load(file_name=json_file_name)
+    if dic is None:
+        return False
+    dic = dict(dic)
+    since_id = dic.pop('notification_since_id', None)
+    if since_id is not None:
+        dic.setdefault('cursors', {})['notification'] = since_id
+    store.import_dict(dic)
+    log.info('JSONファイルから移行しました：%s', json_file_name)
+    return True
@@ -0,0 +1,95 @@
+import json
+import random
+import asyncio
+import logging
+
+try:
+    import websockets
+except ImportError:
+    websockets = None
+
+log = logging.getLogger('hbdbot.streaming')
+
+class StreamingIngest:
+    '''Misskeyのストリーミング（websocket）でノートと通知を受け取る。
+
+    channels: チャンネルのID -> (チャンネル名, パラメータ)
+        例 {'antenna': ('antenna', {'antennaId': '...'}),
+            'ltl': ('localTimeline', {}),
+            'notification': ('main', {})}
+    on_note(id, note): チャンネルにノートが流れてきたときに呼ぶ
+    on_notification(n): mainチャンネルに通知が届いたときに呼ぶ
+    on_connect(): 接続（再接続）するたびに呼ぶ。切れている間の分をRESTで読み直すのに使う
+
+    切断されたら間隔を延ばしながら（ゆらぎ付き）つなぎ直します。'''
+
+    def __init__(self,
+                 url,
+                 channels,
+                 on_note,
+                 on_notification,
+                 on_connect = None,
+                 reconnect_min = 1.0, #sec
+                 reconnect_max = 60.0, #sec
+                 ):
+        if websockets is None:
+            raise ImportError('ストリーミングにはwebsocketsが必要です。'
+                              'pip install websockets')
+        self.url = url
+        self.channels = channels
+        self.on_note = on_note
+        self.on_notification = on_notification
+        self.on_connect = on_connect
+        self.reconnect_min: float = reconnect_min
+        self.reconnect_max: float = reconnect_max
+        self.connected = False
+        self.reconnects = 0
+        self.received = 0
+
+    async def run(self, stop=None):
+        '''stop(asyncio.Event)がセットされるまで受信を続けます。'''
+        delay = self.reconnect_min
+        while stop is None or not stop.is_set():
+            try:
+                async with websockets.connect(self.url) as ws:
+                    self.connected = True
+                    delay = self.reconnect_min
+                    await self.subscribe(ws)
+                    if self.on_connect is not None:
+                        await self.on_connect()
+                    await self.receive(ws, stop)
+            except (OSError, websockets.exceptions.WebSocketException) as e:
+                log.warning('❗❗❗ストリーミング切断❗❗❗ %s', e)
+            finally:
+                self.connected = False
+            if stop is not None and stop.is_set():
+                break
+            self.reconnects += 1
+            await asyncio.sleep(delay * random.uniform(0.5, 1.5))
+            delay = min(self.reconnect_max, delay*2)
+
+    async def subscribe(self, ws):
+        for id, (channel, params) in self.channels.items():
+            await ws.send(json.dumps({
+                'type': 'connect',
+                'body': {'channel': channel, 'id': id, 'params': params}}))
+
+    async def receive(self, ws, stop):
+        async for raw in ws:
+            message = json.loads(raw)
+            if message.get('type') != 'channel':
+                continue
+            body = message['body']
+            self.received += 1
+            if body['type'] == 'note':
+                await self.on_note(body['id'], body['body'])
+            elif body['type'] == 'notification':
+                await self.on_notification(body['body'])
+            if stop is not None and stop.is_set():
+                await ws.close()
+                return
+
+def streaming_url(address, token, scheme='https') -> str:
+    '''インスタンスのアドレスとトークンからストリーミングのURLを作ります。'''
+    ws_scheme = 'wss' if scheme == 'https' else 'ws'
+    return f'{ws_scheme}://{address}/streaming?i={token}'
@@ -0,0 +1,146 @@
+'''複数のワーカー（HBDBotのプロセス）を起動して見守ります。
+
+    python supervisor.py           #shards.jsonのワーカーを起動
+    python supervisor.py --async   #ワーカーを--asyncで起動（--streamも可）
+
+shards.json の例:
+    {"shards": [
+        {"name": "main", "token": "...", "antenna_id": "...",
+         "sources": ["antenna", "ltl", "notification"]},
+        {"name": "sub", "token": "...", "antenna_id": "...",
+         "sources": ["antenna"]}
+    ]}
+nameのほかはHBDBotの設定値で、ワーカーごとの保存ファイル（shards/名前/）に書き込みます。
+ワーカー同士はcoordinator.sqlite3を共有して、一人一日一回のお祝い、
+処理済みのID、アカウントごとの投稿の枠を分け合います。'''
+import os
+import sys
+import time
+import signal
+import subprocess
+
+from JSONSave import JSONSave
+from statestore import SQLiteStateStore
+
+SHARDS_FILE_NAME = 'shards.json'
+COORDINATOR_FILE_NAME = 'coordinator.sqlite3'
+STATE_FILE_NAME = 'state.sqlite3' #HBDBot.pyと同じ
+
+def data_path(file_name) -> str:
+    '''このスクリプトと同じフォルダにあるファイルのパスを返します。'''
+    return os.path.join(os.path.dirname(os.path.abspath(__file__)), file_name)
+
+class Supervisor:
+    '''ワーカーを一つずつ別のプロセスで起動し、落ちたら間隔を延ばしながら起動し直す。'''
+
+    def __init__(self,
+                 shards, #[{'name': ..., 設定値...}]
+                 data_dir,
+                 mode_args = (), #ワーカーに渡す引数（--asyncなど）
+                 restart_min = 5.0, #sec
+                 restart_max = 300.0, #sec
+                 metrics_port = 9464 #ワーカーごとに一つずつずらして割り当てる
+                 ):
+        self.shards = {s['name']: s for s in shards}
+        self.data_dir = data_dir
+        self.mode_args = list(mode_args)
+        self.restart_min: float = restart_min
+        self.restart_max: float = restart_max
+        self.metrics_port: int = metrics_port
+        self.coordinator_file = os.path.join(data_dir, COORDINATOR_FILE_NAME)
+        self.procs = {} #name -> Popen
+        self.started_at = {} #name -> 起動した時刻
+        self.delays = {} #name -> 次に落ちたときに待つ秒数
+        self.restart_at = {} #name -> 起動し直す時刻
+
+    def shard_dir(self, name) -> str:
+        return os.path.join(self.data_dir, 'shards', name)
+
+    def prepare(self):
+        '''ワーカーごとの保存ファイルに設定値を書き込みます。'''
+        for i, (name, shard) in enumerate(self.shards.items()):
+            os.makedirs(self.shard_dir(name), exist_ok=True)
+            store = SQLiteStateStore(os.path.join(self.shard_dir(name),
+                                                  STATE_FILE_NAME))
+            config = dict(shard)
+            del config['name']
+            config.setdefault('metrics_port', self.metrics_port + i
+                              if self.metrics_port else 0)
+            for k, v in config.items():
+                store.set_value(k, v)
+            store.close()
+
+    def command(self, name) -> list:
+        return [sys.executable, data_path('HBDBot.py'),
+                '--data-dir', self.shard_dir(name),
+                '--coordinator', self.coordinator_file] + self.mode_args
+
+    def start(self, name):
+        print('ワーカーを起動：', name)
+        #Ctrl+Cはこのプロセスだけが受け取り、stop()でワーカーに伝える
+        self.procs[name] = subprocess.Popen(self.command(name),
+                                            start_new_session=os.name == 'posix')
+        self.started_at[name] = time.monotonic()
+
+    def check(self):
+        '''終了したワーカーを見つけて、時間をおいて起動し直します。
+        正常に終了した（/koraなどで止めた）ワーカーは起動し直しません。'''
+        now = time.monotonic()
+        for name, proc in list(self.procs.items()):
+            if proc.poll() is None:
+                continue
+            del self.procs[name]
+            if proc.returncode == 0:
+                print(f'ワーカーが終了しました（{name}）')
+                continue
+            #しばらく動いていたなら、待つ時間を元に戻す
+            if now - self.started_at[name] > self.restart_max:
+                self.delays[name] = self.restart_min
+            delay = self.delays.get(name, self.restart_min)
+            self.delays[name] = min(self.restart_max, delay*2)
+            self.restart_at[name] = now + delay
+            print(f'❗❗❗ワーカーが終了（{name}, code={proc.returncode}）❗❗❗'
+                  f' {delay:.0f}秒後に起動し直します')
+        for name, at in list(self.restart_at.items()):
+            if now >= at:
+                del self.restart_at[name]
+                self.start(name)
+
+    def stop(self, timeout=30.0):
+        '''ワーカーに終了を伝え、終わるまで待ちます。'''
+        for proc in self.procs.values():
+            if os.name == 'posix':
+                proc.send_signal(signal.SIGINT) #保存してから終わる
+            else:
+                proc.terminate()
+        for name, proc in self.procs.items():
+            try:
+                proc.wait(timeout)
+            except subprocess.TimeoutExpired:
+                print('❗❗❗ワーカーを強制終了❗❗❗', name)
+                proc.kill()
+        self.procs = {}
+
+    def run(self, interval=1.0):
+        self.prepare()
+        for name in self.shards:
+            self.start(name)
+        try:
+            while self.procs or self.restart_at: #全員正常に終了したら終わる
+                time.sleep(interval)
+                self.check()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            print('ワーカーを終了します。')
+            self.stop()
+
+if __name__ == '__main__':
+    config = JSONSave.load(data_path(SHARDS_FILE_NAME))
+    if not config or not config.get('shards'):
+        print(SHARDS_FILE_NAME, 'にワーカーの設定がありません。')
+        sys.exit(1)
+    Supervisor(config['shards'],
+               data_dir=os.path.dirname(data_path(SHARDS_FILE_NAME)),
+               mode_args=[a for a in sys.argv[1:]
+                          if a in ('--async', '--stream')]).run()
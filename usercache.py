@@ -0,0 +1,71 @@
+import time
+import threading
+from collections import OrderedDict
+
+class UserCache:
+    '''ユーザー情報のキャッシュ（LRU＋有効期限付き）。
+    キーは username@host 形式（ローカルユーザーはusernameのみ）。
+    複数のスレッドから使えます。'''
+
+    def __init__(self, maxsize=2000, ttl=3600.0, clock=time.monotonic):
+        self.maxsize: int = maxsize
+        self.ttl: float = ttl #sec
+        self.clock = clock
+        self._data = OrderedDict() #key -> (保存時刻, 値)
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self._data)
+
+    def __contains__(self, key):
+        return self.get(key, count=False) is not None
+
+    def get(self, key, count=True):
+        '''キャッシュされた値を返します。無いか期限切れならNoneです。'''
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is not None:
+                stored, value = entry
+                if self.clock() - stored < self.ttl:
+                    self._data.move_to_end(key)
+                    if count:
+                        self.hits += 1
+                    return value
+                del self._data[key]
+                self.evictions += 1
+            if count:
+                self.misses += 1
+            return None
+
+    def put(self, key, value):
+        '''値を保存します。上限を超えたら古いものから捨てます。'''
+        with self._lock:
+            self._data[key] = (self.clock(), value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+                self.evictions += 1
+
+    def invalidate(self, key) -> bool:
+        '''指定したキーを破棄します。破棄できたかどうかを返します。'''
+        with self._lock:
+            return self._data.pop(key, None) is not None
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    @property
+    def hit_rate(self) -> float:
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
+
+    def stats(self) -> dict:
+        return {'size': len(self._data),
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'hit_rate': round(self.hit_rate, 3)}
@@ -0,0 +1,57 @@
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+class KeyedPool:
+    '''仕事を複数のスレッドで並行して行う。ただし同じキーの仕事は渡された順に一件ずつ行う。
+
+    work(item): 別のスレッドで呼ぶ（通信など時間のかかる処理。Botの状態には触らない）
+    done(item, result): 結果を受け取る。呼び出し元のスレッドで呼ぶので、
+        Botの状態の更新はここで行う。workが例外を投げたら、その例外がresultになる
+    key(item): 順番を守る単位（ユーザーなど）
+
+    全体の待ち時間は仕事の件数ではなく、workersの数に応じて短くなります。'''
+
+    def __init__(self, work, done, key, workers=4):
+        self.work = work
+        self.done = done
+        self.key = key
+        self.workers: int = workers
+        self._executor = ThreadPoolExecutor(max_workers=workers,
+                                            thread_name_prefix='worker')
+
+    def _work(self, item):
+        #一件が失敗しても、他の仕事の結果は捨てない
+        try:
+            return self.work(item)
+        except Exception as e:
+            return e
+
+    def _run_group(self, items) -> list:
+        return [(item, self._work(item)) for item in items]
+
+    def run(self, items) -> int:
+        '''itemsをすべて処理し終えるまで待ちます。処理した件数を返します。'''
+        groups = {}
+        for item in items:
+            groups.setdefault(self.key(item), []).append(item)
+        if len(groups) <= 1 or self.workers <= 1:
+            for item in items:
+                self.done(item, self._work(item))
+            return len(items)
+        futures = [self._executor.submit(self._run_group, g)
+                   for g in groups.values()]
+        count = 0
+        for future in as_completed(futures):
+            for item, result in future.result():
+                self.done(item, result)
+                count += 1
+        return count
+
+    def resize(self, workers):
+        '''並行して行う数を変えます。run()の外で呼びます。'''
+        self._executor.shutdown(wait=False)
+        self.workers = workers
+        self._executor = ThreadPoolExecutor(max_workers=workers,
+                                            thread_name_prefix='worker')
+
+    def shutdown(self):
+        self._executor.shutdown(wait=False, cancel_futures=True)